@@ -0,0 +1,722 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+
+from network import (Accuracy_Categorical, Accuracy_Regression, Activation_Linear, Activation_ReLU,
+                     Activation_Sigmoid, Activation_Softmax,
+                     Activation_Softmax_Loss_CategoricalCrossentropy, Layer_Conv2D,
+                     Layer_Dense, Layer_Dense_Activation_ReLU, Layer_Dense_Activation_Sigmoid,
+                     Layer_Dropout, Layer_MaxPool2D,
+                     Loss_BinaryCrossentropy, Loss_CategoricalCrossentropy,
+                     Loss_MeanAbsoluteError, Loss_MeanSquaredError, Model, Optimizer_Adagrad,
+                     Optimizer_Adam, Optimizer_RMSprop, Optimizer_SGD)
+
+
+# Reference implementation building a Jacobian matrix for every sample
+def softmax_backward_loop(output, dvalues):
+    dinputs = np.empty_like(dvalues)
+
+    for index, (single_output, single_dvalues) in enumerate(zip(output, dvalues)):
+        single_output = single_output.reshape(-1, 1)
+        jacobian_matrix = np.diagflat(
+            single_output) - np.dot(single_output, single_output.T)
+        dinputs[index] = np.dot(jacobian_matrix, single_dvalues)
+
+    return dinputs
+
+
+def benchmark_softmax_backward(samples=256, classes=(10, 100, 1000), repeat=5):
+    rng = np.random.default_rng(0)
+
+    for n_classes in classes:
+        softmax = Activation_Softmax()
+        softmax.forward(rng.standard_normal((samples, n_classes)), training=True)
+        dvalues = rng.standard_normal((samples, n_classes))
+
+        # Both implementations must produce the same gradient
+        softmax.backward(dvalues)
+        assert np.allclose(softmax.dinputs, softmax_backward_loop(softmax.output, dvalues))
+
+        loop_time = min(timeit.repeat(
+            lambda: softmax_backward_loop(softmax.output, dvalues), number=1, repeat=repeat))
+        vectorized_time = min(timeit.repeat(
+            lambda: softmax.backward(dvalues), number=1, repeat=repeat))
+
+        print(f'Softmax backward | Classes: {n_classes}, Loop: {loop_time * 1e3:.3f}ms, Vectorized: {vectorized_time * 1e3:.3f}ms, Speedup: {loop_time / vectorized_time:.1f}x')
+
+
+# Reference optimizer updates allocating new arrays for every intermediate result
+def sgd_update_allocating(optimizer, layer):
+    if not hasattr(layer, 'weight_momentums'):
+        layer.weight_momentums = np.zeros_like(layer.weights)
+        layer.bias_momentums = np.zeros_like(layer.biases)
+
+    weight_updates = optimizer.momentum * layer.weight_momentums - \
+        optimizer.current_learning_rate * layer.dweights
+    layer.weight_momentums = weight_updates
+    bias_updates = optimizer.momentum * layer.bias_momentums - \
+        optimizer.current_learning_rate * layer.dbiases
+    layer.bias_momentums = bias_updates
+
+    layer.weights += weight_updates
+    layer.biases += bias_updates
+
+
+def rmsprop_update_allocating(optimizer, layer):
+    if not hasattr(layer, 'weight_cache'):
+        layer.weight_cache = np.zeros_like(layer.weights)
+        layer.bias_cache = np.zeros_like(layer.biases)
+
+    layer.weight_cache = optimizer.rho * layer.weight_cache + \
+        (1 - optimizer.rho) * layer.dweights**2
+    layer.bias_cache = optimizer.rho * layer.bias_cache + \
+        (1 - optimizer.rho) * layer.dbiases**2
+
+    layer.weights += -optimizer.current_learning_rate * \
+        layer.dweights / (np.sqrt(layer.weight_cache) + optimizer.epsilon)
+    layer.biases += -optimizer.current_learning_rate * \
+        layer.dbiases / (np.sqrt(layer.bias_cache) + optimizer.epsilon)
+
+
+def adam_update_allocating(optimizer, layer):
+    if not hasattr(layer, 'weight_cache'):
+        layer.weight_momentums = np.zeros_like(layer.weights)
+        layer.weight_cache = np.zeros_like(layer.weights)
+        layer.bias_momentums = np.zeros_like(layer.biases)
+        layer.bias_cache = np.zeros_like(layer.biases)
+
+    layer.weight_momentums = optimizer.beta_1 * \
+        layer.weight_momentums + (1 - optimizer.beta_1) * layer.dweights
+    layer.bias_momentums = optimizer.beta_1 * \
+        layer.bias_momentums + (1 - optimizer.beta_1) * layer.dbiases
+
+    weight_momentums_corrected = layer.weight_momentums / \
+        (1 - optimizer.beta_1 ** (optimizer.iterations + 1))
+    bias_momentums_corrected = layer.bias_momentums / \
+        (1 - optimizer.beta_1 ** (optimizer.iterations + 1))
+
+    layer.weight_cache = optimizer.beta_2 * layer.weight_cache + \
+        (1 - optimizer.beta_2) * layer.dweights**2
+    layer.bias_cache = optimizer.beta_2 * layer.bias_cache + \
+        (1 - optimizer.beta_2) * layer.dbiases**2
+
+    weight_cache_corrected = layer.weight_cache / \
+        (1 - optimizer.beta_2 ** (optimizer.iterations + 1))
+    bias_cache_corrected = layer.bias_cache / \
+        (1 - optimizer.beta_2 ** (optimizer.iterations + 1))
+
+    layer.weights += -optimizer.current_learning_rate * weight_momentums_corrected / \
+        (np.sqrt(weight_cache_corrected) + optimizer.epsilon)
+    layer.biases += -optimizer.current_learning_rate * bias_momentums_corrected / \
+        (np.sqrt(bias_cache_corrected) + optimizer.epsilon)
+
+
+# Time and peak allocations of in-place optimizer steps against the allocating reference
+def benchmark_optimizers(n_inputs=1024, n_neurons=1024, steps=20):
+    rng = np.random.default_rng(0)
+
+    configurations = {
+        'SGD': (lambda: Optimizer_SGD(learning_rate=0.1, decay=1e-3, momentum=0.9), sgd_update_allocating),
+        'RMSprop': (lambda: Optimizer_RMSprop(decay=1e-3), rmsprop_update_allocating),
+        'Adam': (lambda: Optimizer_Adam(decay=1e-3), adam_update_allocating),
+    }
+
+    gradients = [(rng.standard_normal((n_inputs, n_neurons)), rng.standard_normal((1, n_neurons)))
+                 for _ in range(steps)]
+
+    for name, (create_optimizer, update_allocating) in configurations.items():
+        results = {}
+
+        for version in ('allocating', 'in_place'):
+            optimizer = create_optimizer()
+            np.random.seed(0)
+            layer = Layer_Dense(n_inputs, n_neurons)
+
+            def step(dweights, dbiases):
+                layer.dweights, layer.dbiases = dweights, dbiases
+                optimizer.pre_update_params()
+                if version == 'in_place':
+                    optimizer.update_params(layer)
+                else:
+                    update_allocating(optimizer, layer)
+                optimizer.post_update_params()
+
+            # First step creates optimizer state and scratch arrays
+            step(*gradients[0])
+
+            start = time.perf_counter()
+            for dweights, dbiases in gradients[1:]:
+                step(dweights, dbiases)
+            step_time = (time.perf_counter() - start) / (steps - 1)
+
+            tracemalloc.start()
+            step(*gradients[0])
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results[version] = (step_time, peak, layer.weights)
+
+        # Numerical results are identical
+        assert np.array_equal(results['allocating'][2], results['in_place'][2])
+
+        for version, (step_time, peak, _) in results.items():
+            print(f'Optimizer | {name} {version}: Step: {step_time * 1e3:.3f}ms, Peak_Alloc: {peak / 2**20:.2f}MiB')
+
+
+# Optimizer step time with per-layer updates against one update of the flat parameters
+def benchmark_flat_parameters(depth=32, width=16, steps=200):
+    for flat_parameters in (False, True):
+        model = build_classifier(width, width, 10, depth=depth)
+        model.finalize(flat_parameters=flat_parameters)
+
+        # One backward pass to have gradients
+        X, y = classification_data(64, width, 10)
+        model.backward(model.forward(X, training=True), y)
+        model.optimize()
+
+        step_time = min(timeit.repeat(model.optimize, number=steps, repeat=3)) / steps
+        print(f'Flat parameters | {flat_parameters}: Depth: {depth}, Width: {width}, Step: {step_time * 1e6:.1f}us')
+
+
+# Forward and backward of a dense layer with its activation, as separate layers and fused
+def benchmark_fused_layers(samples=1024, width=512, repeat=5):
+    rng = np.random.default_rng(0)
+    inputs = rng.standard_normal((samples, width))
+    dvalues = rng.standard_normal((samples, width))
+
+    for activation_type, fused_type in ((Activation_ReLU, Layer_Dense_Activation_ReLU),
+                                        (Activation_Sigmoid, Layer_Dense_Activation_Sigmoid)):
+        dense = Layer_Dense(width, width)
+        activation = activation_type()
+        fused = fused_type(dense, activation)
+        for obj in (dense, activation, fused):
+            obj.reuse_buffers = True
+
+        # The fused backward works in place on its gradient, so both steps start from a fresh copy
+        gradient = np.empty_like(dvalues)
+
+        def separate_step():
+            dense.forward(inputs, training=True)
+            activation.forward(dense.output, training=True)
+            np.copyto(gradient, dvalues)
+            activation.backward(gradient)
+            dense.backward(activation.dinputs)
+
+        def fused_step():
+            fused.forward(inputs, training=True)
+            np.copyto(gradient, dvalues)
+            fused.backward(gradient)
+
+        # Both must produce the same gradients
+        separate_step()
+        separate_dweights = dense.dweights.copy()
+        fused_step()
+        assert np.array_equal(separate_dweights, dense.dweights)
+
+        separate_time = min(timeit.repeat(separate_step, number=1, repeat=repeat))
+        fused_time = min(timeit.repeat(fused_step, number=1, repeat=repeat))
+
+        print(f'Fused layers | {activation_type.__name__}: Samples: {samples}, Width: {width}, Separate: {separate_time * 1e3:.3f}ms, Fused: {fused_time * 1e3:.3f}ms, Speedup: {separate_time / fused_time:.2f}x')
+
+
+# Dropout masks from 16 random bits per value against binomial sampling
+def benchmark_dropout_masks(samples=256, width=1024, rate=0.1, repeat=5):
+    layer = Layer_Dropout(rate)
+    layer.random = np.random.default_rng(0)
+    inputs = np.random.default_rng(1).standard_normal((samples, width))
+
+    def binomial():
+        return (np.random.binomial(1, layer.rate, size=inputs.shape) / layer.rate) * inputs
+
+    reference_time = min(timeit.repeat(binomial, number=10, repeat=repeat)) / 10
+    bits_time = min(timeit.repeat(lambda: layer.forward(inputs, True), number=10, repeat=repeat)) / 10
+    print(f'Dropout | {samples}x{width}: Binomial: {reference_time * 1e3:.3f}ms, '
+          f'Bits: {bits_time * 1e3:.3f}ms, Speedup: {reference_time / bits_time:.1f}x')
+
+
+# Reference convolution looping over output positions, inputs are (samples, height, width, channels)
+def conv2d_loop(inputs, weights, biases, stride, padding):
+    inputs = np.pad(inputs, ((0, 0), (padding, padding), (padding, padding), (0, 0)))
+    kernel_size, _, _, filters = weights.shape
+    out_height = (inputs.shape[1] - kernel_size) // stride + 1
+    out_width = (inputs.shape[2] - kernel_size) // stride + 1
+    kernel = weights.reshape(-1, filters)
+
+    output = np.empty((len(inputs), out_height, out_width, filters))
+    for y in range(out_height):
+        for x in range(out_width):
+            window = inputs[:, y*stride:y*stride+kernel_size, x*stride:x*stride+kernel_size]
+            output[:, y, x] = window.reshape(len(inputs), -1) @ kernel + biases[0]
+    return output
+
+
+# Reference gradients of conv2d_loop on weights and inputs
+def conv2d_backward_loop(inputs, weights, dvalues, stride, padding):
+    padded = np.pad(inputs, ((0, 0), (padding, padding), (padding, padding), (0, 0)))
+    kernel_size, _, _, filters = weights.shape
+    kernel = weights.reshape(-1, filters)
+    dkernel = np.zeros_like(kernel)
+    dpadded = np.zeros_like(padded)
+
+    for y in range(dvalues.shape[1]):
+        for x in range(dvalues.shape[2]):
+            rows = slice(y*stride, y*stride+kernel_size)
+            columns = slice(x*stride, x*stride+kernel_size)
+            window = padded[:, rows, columns]
+            dkernel += window.reshape(len(inputs), -1).T @ dvalues[:, y, x]
+            dpadded[:, rows, columns] += (dvalues[:, y, x] @ kernel.T).reshape(window.shape)
+
+    dweights = dkernel.reshape(weights.shape)
+    height, width = inputs.shape[1:3]
+    return dweights, dpadded[:, padding:padding+height, padding:padding+width]
+
+
+# Reference max pooling looping over output positions
+def maxpool2d_loop(inputs, pool_size, stride):
+    out_height = (inputs.shape[1] - pool_size) // stride + 1
+    out_width = (inputs.shape[2] - pool_size) // stride + 1
+
+    output = np.empty((len(inputs), out_height, out_width, inputs.shape[3]))
+    for y in range(out_height):
+        for x in range(out_width):
+            window = inputs[:, y*stride:y*stride+pool_size, x*stride:x*stride+pool_size]
+            output[:, y, x] = window.max(axis=(1, 2))
+    return output
+
+
+# Strided-window convolution and pooling layers against loops over output positions. The loops
+# work on all samples at once, so their Python overhead matters most for small batches
+def benchmark_convolution(samples=(1, 32), size=28, channels=8, filters=16, kernel_size=3, repeat=3):
+    for n_samples in samples:
+        benchmark_convolution_batch(n_samples, size, channels, filters, kernel_size, repeat)
+
+
+def benchmark_convolution_batch(samples, size, channels, filters, kernel_size, repeat):
+    rng = np.random.default_rng(0)
+    inputs = rng.standard_normal((samples, size, size, channels))
+
+    for stride, padding in ((1, 1), (2, 0)):
+        conv = Layer_Conv2D(channels, filters, kernel_size, stride=stride, padding=padding)
+        conv.forward(inputs, training=True)
+        dvalues = rng.standard_normal(conv.output.shape)
+        conv.backward(dvalues)
+
+        # Both implementations must produce the same results
+        dweights, dinputs = conv2d_backward_loop(inputs, conv.weights, dvalues, stride, padding)
+        assert np.allclose(conv.output, conv2d_loop(inputs, conv.weights, conv.biases, stride, padding))
+        assert np.allclose(conv.dweights, dweights) and np.allclose(conv.dinputs, dinputs)
+
+        loop_time = min(timeit.repeat(
+            lambda: (conv2d_loop(inputs, conv.weights, conv.biases, stride, padding),
+                     conv2d_backward_loop(inputs, conv.weights, dvalues, stride, padding)),
+            number=1, repeat=repeat))
+        windowed_time = min(timeit.repeat(
+            lambda: (conv.forward(inputs, training=True), conv.backward(dvalues)), number=1, repeat=repeat))
+
+        print(f'Conv2D forward+backward | Input: {samples}x{size}x{size}x{channels}, Filters: {filters}, Kernel: {kernel_size}, Stride: {stride}, Padding: {padding}, Loop: {loop_time * 1e3:.3f}ms, Windows: {windowed_time * 1e3:.3f}ms, Speedup: {loop_time / windowed_time:.1f}x')
+
+    pool = Layer_MaxPool2D(2)
+    pool.forward(inputs, training=True)
+    assert np.array_equal(pool.output, maxpool2d_loop(inputs, 2, 2))
+
+    loop_time = min(timeit.repeat(lambda: maxpool2d_loop(inputs, 2, 2), number=1, repeat=repeat))
+    windowed_time = min(timeit.repeat(lambda: pool.forward(inputs, training=True), number=1, repeat=repeat))
+    print(f'MaxPool2D forward | Input: {samples}x{size}x{size}x{channels}, Pool: 2, Loop: {loop_time * 1e3:.3f}ms, Windows: {windowed_time * 1e3:.3f}ms, Speedup: {loop_time / windowed_time:.1f}x')
+
+
+# Synthetic classification data - class centers plus gaussian noise
+def classification_data(samples, features, classes, seed=0):
+    # Centers are the same for every seed, so differently seeded sets share classes
+    centers = np.random.default_rng(classes).standard_normal((classes, features)) * 0.15
+
+    rng = np.random.default_rng(seed)
+    y = rng.integers(0, classes, size=samples)
+    X = centers[y] + rng.standard_normal((samples, features))
+    return X, y
+
+
+def build_classifier(features, width, classes, depth=2, **model_options):
+    np.random.seed(0)
+
+    model = Model(**model_options)
+    inputs = features
+    for _ in range(depth):
+        model.add(Layer_Dense(inputs, width))
+        model.add(Activation_ReLU())
+        inputs = width
+    model.add(Layer_Dense(inputs, classes))
+    model.add(Activation_Softmax())
+
+    model.set(loss=Loss_CategoricalCrossentropy(),
+              optimizer=Optimizer_Adam(learning_rate=0.001),
+              accuracy=Accuracy_Categorical())
+    model.finalize()
+    return model
+
+
+# Training time and validation accuracy of float32 and mixed precision against float64
+def benchmark_precision(samples=20000, features=128, width=512, classes=10, epochs=3, batch_size=256):
+    X, y = classification_data(samples, features, classes)
+    X_val, y_val = classification_data(samples // 4, features, classes, seed=1)
+
+    configurations = {
+        'float64': {'dtype': np.float64},
+        'float32': {'dtype': np.float32},
+        'mixed': {'dtype': np.float32, 'master_dtype': np.float64},
+    }
+
+    for name, model_options in configurations.items():
+        model = build_classifier(features, width, classes, **model_options)
+
+        start = time.perf_counter()
+        model.train(X, y, epochs=epochs, batch_size=batch_size, print_every=epochs + 1)
+        train_time = time.perf_counter() - start
+
+        predictions = model.output_layer_activation.predictions(model.predict(X_val))
+        accuracy = np.mean(predictions == y_val)
+
+        print(f'Precision | {name}: Train: {train_time:.3f}s, Val_Acc: {accuracy:.3f}')
+
+
+# Accuracy, data loss, parameter bytes saved and held in memory while serving, and inference time
+# per batch size of a quantized model against the float model it was made from. Both are scored with the float model's loss and
+# accuracy objects, so Accuracy_Regression uses the same precision for both
+def quantization_report(model, quantized, X, y, *, batch_sizes=(1, 256), repeat=5):
+    y = model.class_indices(y)
+    model.accuracy.init(y)
+
+    report = {}
+    for name, candidate in (('float', model), ('int8', quantized)):
+        output = candidate.predict(X)
+        predictions = candidate.output_layer_activation.predictions(output)
+        model.loss.new_pass()
+        model.accuracy.new_pass()
+        result = {'accuracy': float(model.accuracy.calculate(predictions, y)),
+                  'loss': float(model.loss.calculate(output, y)),
+                  'bytes': candidate.parameter_bytes()}
+        # Quantized layers keep float copies of their weights for the matrix products
+        result['memory_bytes'] = result['bytes'] + sum(
+            getattr(layer, name).nbytes for layer in candidate.layers
+            for name in ('float_weights', 'output_scales') if hasattr(layer, name))
+
+        for batch_size in batch_sizes:
+            batch = X[:batch_size]
+            number = max(1, 2048 // batch_size)
+            result[f'time_{batch_size}'] = min(timeit.repeat(
+                lambda: candidate.infer(batch), number=number, repeat=repeat)) / number
+
+        report[name] = result
+    return report
+
+
+def print_quantization_report(name, report):
+    base, quantized = report['float'], report['int8']
+    times = ', '.join(f'Batch {key[5:]}: {base[key] * 1e3:.3f}ms -> {quantized[key] * 1e3:.3f}ms'
+                      for key in base if key.startswith('time_'))
+    print(f'Quantization | {name}: Acc: {base["accuracy"]:.3f} -> {quantized["accuracy"]:.3f}, '
+          f'Loss: {base["loss"]:.4f} -> {quantized["loss"]:.4f}, '
+          f'Size: {base["bytes"] / 1e6:.2f}MB -> {quantized["bytes"] / 1e6:.2f}MB, '
+          f'Memory: {base["memory_bytes"] / 1e6:.2f}MB -> {quantized["memory_bytes"] / 1e6:.2f}MB, {times}')
+
+
+# Post-training int8 quantization of a classifier and a regression model against float64
+def benchmark_quantization(samples=20000, features=128, width=512, classes=10, epochs=3, batch_size=256):
+    X, y = classification_data(samples, features, classes)
+    X_val, y_val = classification_data(samples // 4, features, classes, seed=1)
+
+    model = build_classifier(features, width, classes)
+    model.train(X, y, epochs=epochs, batch_size=batch_size, print_every=epochs + 1)
+    quantized = model.quantized(X[:1000])
+    print_quantization_report('classifier', quantization_report(model, quantized, X_val, y_val))
+
+    # Regression of a smooth function of the features
+    rng = np.random.default_rng(0)
+    projection = rng.standard_normal((features, 1)) / np.sqrt(features)
+    y, y_val = np.sin(X @ projection), np.sin(X_val @ projection)
+
+    np.random.seed(0)
+    model = Model()
+    model.add(Layer_Dense(features, width))
+    model.add(Activation_ReLU())
+    model.add(Layer_Dense(width, width))
+    model.add(Activation_ReLU())
+    model.add(Layer_Dense(width, 1))
+    model.add(Activation_Linear())
+    model.set(loss=Loss_MeanSquaredError(), optimizer=Optimizer_Adam(learning_rate=0.001),
+              accuracy=Accuracy_Regression())
+    model.finalize()
+    model.train(X, y, epochs=epochs, batch_size=batch_size, print_every=epochs + 1)
+    quantized = model.quantized(X[:1000])
+    print_quantization_report('regression', quantization_report(model, quantized, X_val, y_val))
+
+
+# Training throughput with the batch split across worker processes
+def benchmark_data_parallel(workers=(1, 2, 4), samples=20000, features=128, width=512, classes=10, batch_size=1024):
+    X, y = classification_data(samples, features, classes)
+
+    for worker_count in workers:
+        model = build_classifier(features, width, classes)
+
+        start = time.perf_counter()
+        model.train(X, y, epochs=1, batch_size=batch_size, print_every=2, workers=worker_count)
+        train_time = time.perf_counter() - start
+
+        print(f'Data parallel | Workers: {worker_count}, Train: {train_time:.3f}s, Samples/s: {samples / train_time:.0f}')
+
+
+# Time, throughput and allocations of a call - timed without tracing, then traced once
+def measure(function, samples, repeat=5, number=None):
+    if number is None:
+        # Enough calls per timing to run for roughly 20ms
+        single = timeit.timeit(function, number=1)
+        number = max(1, min(1000, int(0.02 / max(single, 1e-9))))
+
+    call_time = min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    function()
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    # Memory blocks allocated by the call and still alive after it
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename')
+                          if stat.count_diff > 0)
+
+    return {'time': call_time, 'samples_per_sec': samples / call_time,
+            'peak_bytes': peak, 'retained_blocks': retained_blocks}
+
+
+# Forward and backward calls of a layer or activation on a (batch, width) input
+def layer_cases(layer, batch_size, width, rng):
+    inputs = rng.standard_normal((batch_size, width))
+    layer.forward(inputs, training=True)
+    dvalues = rng.standard_normal(layer.output.shape)
+
+    return {'forward': lambda: layer.forward(inputs, training=True),
+            'backward': lambda: layer.backward(dvalues)}
+
+
+# Loss calculation and backward calls with matching predictions and targets
+def loss_cases(loss, batch_size, width, rng):
+    if isinstance(loss, (Loss_CategoricalCrossentropy, Activation_Softmax_Loss_CategoricalCrossentropy)):
+        softmax = Activation_Softmax()
+        softmax.forward(rng.standard_normal((batch_size, width)), training=False)
+        y_pred = softmax.output
+        y_true = rng.integers(0, width, size=batch_size)
+    elif isinstance(loss, Loss_BinaryCrossentropy):
+        y_pred = rng.uniform(0.01, 0.99, size=(batch_size, width))
+        y_true = rng.integers(0, 2, size=(batch_size, width)).astype(float)
+    else:
+        y_pred = rng.standard_normal((batch_size, width))
+        y_true = rng.standard_normal((batch_size, width))
+
+    cases = {'backward': lambda: loss.backward(y_pred, y_true)}
+    if hasattr(loss, 'calculate'):
+        cases['calculate'] = lambda: loss.calculate(y_pred, y_true)
+    return cases
+
+
+def run_suite(batch_sizes, widths, depths, samples, repeat):
+    results = []
+
+    # samples is the number of samples (or parameters for optimizers) one call processes
+    def record(name, function, samples, **params):
+        np.random.seed(0)
+        result = {'name': name, 'params': params, 'samples': samples}
+        result.update(measure(function, samples, repeat))
+        results.append(result)
+        print(f"{name} {result['params']}: {result['time'] * 1e3:.3f}ms, "
+              f"{result['samples_per_sec']:.0f} samples/s, Peak: {result['peak_bytes'] / 2**20:.2f}MiB")
+
+    layers = {
+        'Layer_Dense': lambda width: Layer_Dense(width, width),
+        'Activation_ReLU': lambda width: Activation_ReLU(),
+        'Activation_Softmax': lambda width: Activation_Softmax(),
+        'Activation_Sigmoid': lambda width: Activation_Sigmoid(),
+        'Activation_Linear': lambda width: Activation_Linear(),
+    }
+    losses = {
+        'Loss_CategoricalCrossentropy': Loss_CategoricalCrossentropy,
+        'Activation_Softmax_Loss_CategoricalCrossentropy': Activation_Softmax_Loss_CategoricalCrossentropy,
+        'Loss_BinaryCrossentropy': Loss_BinaryCrossentropy,
+        'Loss_MeanSquaredError': Loss_MeanSquaredError,
+        'Loss_MeanAbsoluteError': Loss_MeanAbsoluteError,
+    }
+    optimizers = {
+        'Optimizer_SGD': lambda: Optimizer_SGD(decay=1e-3),
+        'Optimizer_SGD_momentum': lambda: Optimizer_SGD(decay=1e-3, momentum=0.9),
+        'Optimizer_Adagrad': lambda: Optimizer_Adagrad(decay=1e-3),
+        'Optimizer_RMSprop': lambda: Optimizer_RMSprop(decay=1e-3),
+        'Optimizer_Adam': lambda: Optimizer_Adam(decay=1e-3),
+    }
+
+    for batch_size, width in itertools.product(batch_sizes, widths):
+        rng = np.random.default_rng(0)
+
+        for name, create_layer in layers.items():
+            np.random.seed(0)
+            for phase, function in layer_cases(create_layer(width), batch_size, width, rng).items():
+                record(f'{name}.{phase}', function, batch_size, batch_size=batch_size, width=width)
+
+        for name, create_loss in losses.items():
+            for phase, function in loss_cases(create_loss(), batch_size, width, rng).items():
+                record(f'{name}.{phase}', function, batch_size, batch_size=batch_size, width=width)
+
+    # Optimizer steps depend on parameter count only
+    for width in widths:
+        for name, create_optimizer in optimizers.items():
+            np.random.seed(0)
+            optimizer = create_optimizer()
+            layer = Layer_Dense(width, width)
+            layer.dweights = np.full_like(layer.weights, 0.01)
+            layer.dbiases = np.full_like(layer.biases, 0.01)
+
+            def step():
+                optimizer.pre_update_params()
+                optimizer.update_params(layer)
+                optimizer.post_update_params()
+
+            record(f'{name}.update_params', step, layer.weights.size + layer.biases.size, width=width)
+
+    # Fresh interpreter import of the library
+    result = {'name': 'import network', 'params': {}, 'samples': 1}
+    result.update(benchmark_startup(repeat))
+    results.append(result)
+    print(f"import network: {result['time'] * 1e3:.1f}ms, Modules: {result['modules']}")
+
+    # End-to-end training epochs and batched inference
+    features, classes = 64, 10
+    X, y = classification_data(samples, features, classes)
+    for batch_size, width, depth in itertools.product(batch_sizes, widths, depths):
+        model = build_classifier(features, width, classes, depth=depth)
+        record('Model.train', lambda: model.train(X, y, epochs=1, batch_size=batch_size, print_every=2),
+               samples, batch_size=batch_size, width=width, depth=depth)
+        record('Model.predict', lambda: model.predict(X, batch_size=batch_size),
+               samples, batch_size=batch_size, width=width, depth=depth)
+
+    return results
+
+
+# Time to import network in a new interpreter, which must not load plotting libraries
+def benchmark_startup(repeat=5):
+    code = ('import sys, time; start = time.perf_counter(); import network; '
+            'print(time.perf_counter() - start, len(sys.modules), "matplotlib" in sys.modules)')
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], cwd=directory, capture_output=True,
+                                text=True, check=True).stdout.split()
+        times.append(float(output[0]))
+        modules = int(output[1])
+        assert output[2] == 'False', 'importing network loaded matplotlib'
+
+    return {'time': min(times), 'samples_per_sec': 1 / min(times), 'peak_bytes': 0,
+            'retained_blocks': 0, 'modules': modules}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'processor': platform.processor()}
+
+
+def result_key(result):
+    return result['name'] + ' ' + json.dumps(result['params'], sort_keys=True)
+
+
+# Prints the time ratio of every result found in both files, returns the number of regressions
+def compare(baseline_path, candidate_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {result_key(result): result for result in json.load(f)['results']}
+    with open(candidate_path) as f:
+        candidate = {result_key(result): result for result in json.load(f)['results']}
+
+    regressions = 0
+    for key in sorted(baseline.keys() & candidate.keys()):
+        ratio = candidate[key]['time'] / baseline[key]['time']
+        memory = candidate[key]['peak_bytes'] - baseline[key]['peak_bytes']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print(f'{key}: {ratio:.2f}x time, {memory / 2**20:+.2f}MiB peak{flag}')
+
+    return regressions
+
+
+# Side by side comparisons of optimized code paths with their references
+def run_comparisons():
+    benchmark_softmax_backward()
+    benchmark_optimizers()
+    benchmark_flat_parameters()
+    benchmark_fused_layers()
+    benchmark_dropout_masks()
+    benchmark_convolution()
+    benchmark_precision()
+    benchmark_quantization()
+    benchmark_data_parallel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for network.py')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='run the benchmark grid and save results')
+    run_parser.add_argument('--output', default='benchmark_results.json')
+    run_parser.add_argument('--quick', action='store_true', help='small grid for a fast check')
+    run_parser.add_argument('--repeat', type=int, default=5)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative slowdown reported as a regression')
+
+    subparsers.add_parser('comparisons', help='compare optimized code paths with references')
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        sys.exit(1 if compare(args.baseline, args.candidate, args.threshold) else 0)
+
+    if args.command == 'comparisons':
+        run_comparisons()
+        return
+
+    quick = args.command == 'run' and args.quick
+    repeat = args.repeat if args.command == 'run' else 5
+    output = args.output if args.command == 'run' else 'benchmark_results.json'
+
+    if quick:
+        grid = {'batch_sizes': (32,), 'widths': (64,), 'depths': (2,), 'samples': 2048}
+    else:
+        grid = {'batch_sizes': (32, 256), 'widths': (64, 512), 'depths': (2, 4), 'samples': 16384}
+
+    results = run_suite(repeat=repeat, **grid)
+
+    with open(output, 'w') as f:
+        json.dump({'environment': environment(), 'grid': grid, 'results': results}, f, indent=2)
+    print(f'Saved {len(results)} results to {output}')
+
+
+if __name__ == '__main__':
+    main()
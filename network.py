@@ -1,11 +1,162 @@
-import matplotlib.pyplot as plt
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+import tracemalloc
+from multiprocessing import shared_memory
+
 import numpy as np
 
 
+# Uninitialized array for results of a layer or loss. With reuse_buffers set on the object
+# (see Model.finalize) the same memory is returned again on every call, it is reallocated
+# only when a batch needs more rows or a different shape or dtype.
+def layer_buffer(obj, name, shape, dtype):
+    if not getattr(obj, 'reuse_buffers', False):
+        return np.empty(shape, dtype=dtype)
+
+    if 'buffers' not in vars(obj):
+        obj.buffers = {}
+
+    buffer = obj.buffers.get(name)
+    if buffer is None or len(buffer) < shape[0] or buffer.shape[1:] != tuple(shape[1:]) or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        obj.buffers[name] = buffer
+
+    # Rows of a C-contiguous buffer are a contiguous view, usable as out= of np.dot
+    return buffer[:shape[0]]
+
+
+# PCG64 random generator. Without a seed it is seeded from the global NumPy random state,
+# so np.random.seed still makes runs repeatable
+def new_generator(seed=None):
+    if seed is None:
+        seed = np.random.randint(2**63, dtype=np.int64)
+    return np.random.Generator(np.random.PCG64(int(seed)))
+
+
+# Generator of a PCG64 state saved with bit_generator.state
+def generator_from_state(state, seed_sequence=None):
+    random = np.random.Generator(np.random.PCG64(seed_sequence))
+    random.bit_generator.state = state
+    return random
+
+
+# Compressed sparse row matrix - row values in data, their column numbers in indices and
+# the start of every row in indptr. Accepted by Layer_Dense as inputs, scipy.sparse CSR
+# matrices work the same way.
+class Matrix_CSR:
+    def __init__(self, data, indices, indptr, shape):
+        self.data = np.asarray(data)
+        self.indices = np.asarray(indices)
+        self.indptr = np.asarray(indptr)
+        self.shape = tuple(shape)
+
+    @staticmethod
+    def from_dense(array):
+        array = np.asarray(array)
+        rows, columns = np.nonzero(array)
+        indptr = np.zeros(array.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=array.shape[0]), out=indptr[1:])
+        return Matrix_CSR(array[rows, columns], columns, indptr, array.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    # Rows selected by a slice or an array of row numbers
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.shape[0])
+            if step == 1:
+                stop = max(start, stop)
+                begin, end = self.indptr[start], self.indptr[stop]
+                return Matrix_CSR(self.data[begin:end], self.indices[begin:end],
+                                  self.indptr[start:stop+1] - begin, (stop - start, self.shape[1]))
+            rows = np.arange(start, stop, step)
+
+        rows = np.asarray(rows)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        indptr = np.zeros(len(rows) + 1, dtype=self.indptr.dtype)
+        np.cumsum(lengths, out=indptr[1:])
+
+        # Position of every gathered value in the original data
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return Matrix_CSR(self.data[positions], self.indices[positions], indptr,
+                          (len(rows), self.shape[1]))
+
+    def astype(self, dtype, copy=True):
+        return Matrix_CSR(self.data.astype(dtype, copy=copy), self.indices, self.indptr, self.shape)
+
+    def toarray(self):
+        array = np.zeros(self.shape, dtype=self.data.dtype)
+        array[np.repeat(np.arange(self.shape[0]), np.diff(self.indptr)), self.indices] = self.data
+        return array
+
+
+def is_sparse(array):
+    return hasattr(array, 'indptr')
+
+
+# Product of sparse inputs and dense weights written into out, cost scales with the number of nonzeros
+def sparse_dot(inputs, weights, out):
+    # Weight rows of the present features scaled by their values, summed per sample
+    contributions = inputs.data[:, None] * weights[inputs.indices]
+
+    out[...] = 0
+    nonempty = np.diff(inputs.indptr) > 0
+    if contributions.size:
+        out[nonempty] = np.add.reduceat(contributions, inputs.indptr[:-1][nonempty], axis=0)
+    return out
+
+
+# Adds the gradients of the weight regularization of layer to dweights in place,
+# weights are the weight rows dweights belongs to
+def add_weight_regularization(layer, dweights, weights):
+    # L1 on weights
+    if layer.weight_regularizer_l1 > 0:
+        dL1 = np.ones_like(weights)
+        dL1[weights < 0] = -1
+        dweights += layer.weight_regularizer_l1 * dL1
+    # L2 on weights
+    if layer.weight_regularizer_l2 > 0:
+        dweights += 2 * layer.weight_regularizer_l2 * weights
+
+
+# Adds the gradients of the bias regularization of layer to its dbiases in place
+def add_bias_regularization(layer):
+    # L1 on biases
+    if layer.bias_regularizer_l1 > 0:
+        dL1 = np.ones_like(layer.biases)
+        dL1[layer.biases < 0] = -1
+        layer.dbiases += layer.bias_regularizer_l1 * dL1
+    # L2 on biases
+    if layer.bias_regularizer_l2 > 0:
+        layer.dbiases += 2 * layer.bias_regularizer_l2 * \
+            layer.biases
+
+
+# Sets a gradient of layer - written into the existing array when it matches,
+# as that can be a view into the model's flat gradient buffer
+def set_gradient(layer, name, gradient):
+    existing = getattr(layer, name, None)
+    if existing is not None and existing.shape == gradient.shape and existing.dtype == gradient.dtype:
+        existing[...] = gradient
+    else:
+        setattr(layer, name, gradient)
+
+
 class Layer_Dense:
-    def __init__(self, n_inputs, n_neurons, weight_regularizer_l1=0, weight_regularizer_l2=0, bias_regularizer_l1=0, bias_regularizer_l2=0):
+    # Initial weights are drawn from random, a NumPy Generator such as Model.random, or from the
+    # global random state without one
+    def __init__(self, n_inputs, n_neurons, weight_regularizer_l1=0, weight_regularizer_l2=0, bias_regularizer_l1=0, bias_regularizer_l2=0, *, random=None):
         # Initialize weights and biases
-        self.weights = 0.1 * np.random.randn(n_inputs, n_neurons)
+        self.weights = 0.1 * (np.random if random is None else random).standard_normal((n_inputs, n_neurons))
         self.biases = np.zeros((1, n_neurons))
 
         # Set regularization strength
@@ -16,37 +167,154 @@ class Layer_Dense:
 
     def forward(self, inputs, training):
         self.inputs = inputs
-        self.output = np.dot(inputs, self.weights) + self.biases
+        if is_sparse(inputs):
+            self.output = layer_buffer(self, 'output', (inputs.shape[0], self.weights.shape[1]),
+                                       np.result_type(inputs.data, self.weights))
+            sparse_dot(inputs, self.weights, self.output)
+        else:
+            self.output = layer_buffer(self, 'output', (len(inputs), self.weights.shape[1]),
+                                       np.result_type(inputs, self.weights))
+            np.dot(inputs, self.weights, out=self.output)
+        self.output += self.biases
 
     def backward(self, dvalues):
-        # Gradients on parameters
-        self.dweights = np.dot(self.inputs.T, dvalues)
-        self.dbiases = np.sum(dvalues, axis=0, keepdims=True)
+        sparse = is_sparse(self.inputs)
+
+        # Gradients on parameters - written into the existing arrays when they match,
+        # as those can be views into the model's flat gradient buffer
+        if sparse:
+            dtype = np.result_type(self.inputs.data, dvalues)
+        else:
+            dtype = np.result_type(self.inputs, dvalues)
+        if hasattr(self, 'dbiases') and self.dbiases.dtype == dtype:
+            np.sum(dvalues, axis=0, keepdims=True, out=self.dbiases)
+        else:
+            self.dbiases = np.sum(dvalues, axis=0, keepdims=True)
+
+        if sparse:
+            # Row-sparse gradient of the weight rows of features present in the batch,
+            # regularization is applied lazily to those rows only
+            weights = self.sparse_weight_gradients(dvalues)
+        else:
+            weights = self.weights
+            self.dweights_rows = None
+            if hasattr(self, 'dweights') and self.dweights.shape == self.weights.shape and self.dweights.dtype == dtype:
+                np.dot(self.inputs.T, dvalues, out=self.dweights)
+            else:
+                self.dweights = np.dot(self.inputs.T, dvalues)
 
         # Gradients on regularization
-        # L1 on weights
-        if self.weight_regularizer_l1 > 0:
-            dL1 = np.ones_like(self.weights)
-            dL1[self.weights < 0] = -1
-            self.dweights += self.weight_regularizer_l1 * dL1
-        # L2 on weights
-        if self.weight_regularizer_l2 > 0:
-            self.dweights += 2 * self.weight_regularizer_l2 * self.weights
-        # L1 on biases
-        if self.bias_regularizer_l1 > 0:
-            dL1 = np.ones_like(self.biases)
-            dL1[self.biases < 0] = -1
-            self.dbiases += self.bias_regularizer_l1 * dL1
-        # L2 on biases
-        if self.bias_regularizer_l2 > 0:
-            self.dbiases += 2 * self.bias_regularizer_l2 * \
-                self.biases
+        add_weight_regularization(self, self.dweights, weights)
+        add_bias_regularization(self)
+
+        # Sparse inputs come straight from the data, there is nothing to pass gradients to
+        if sparse:
+            self.dinputs = None
+            if getattr(self, 'dense_gradients', False):
+                self.scatter_weight_gradients()
+            return
 
         # Gradient on values
-        self.dinputs = np.dot(dvalues, self.weights.T)
+        self.dinputs = layer_buffer(self, 'dinputs', (len(dvalues), self.weights.shape[0]),
+                                    np.result_type(dvalues, self.weights))
+        np.dot(dvalues, self.weights.T, out=self.dinputs)
+
+    # Sets dweights to the gradients of the weight rows in dweights_rows, returns those weight rows
+    def sparse_weight_gradients(self, dvalues):
+        inputs = self.inputs
+        rows, inverse, counts = np.unique(inputs.indices, return_inverse=True, return_counts=True)
+
+        # Every nonzero input scales the gradient row of its sample
+        samples = np.repeat(np.arange(len(dvalues)), np.diff(inputs.indptr))
+        contributions = inputs.data[:, None] * dvalues[samples]
+
+        # Contributions to the same weight row are grouped and summed
+        if len(rows):
+            order = np.argsort(inverse, kind='stable')
+            starts = np.zeros(len(rows), dtype=np.intp)
+            np.cumsum(counts[:-1], out=starts[1:])
+            self.dweights = np.add.reduceat(contributions[order], starts, axis=0)
+        else:
+            self.dweights = np.zeros((0, self.weights.shape[1]), dtype=contributions.dtype)
+        self.dweights_rows = rows
+
+        return self.weights[rows]
+
+    # Writes row-sparse gradients into the full dense gradient array, used with flat parameters
+    def scatter_weight_gradients(self):
+        rows_gradients = self.dweights
+        self.dweights = self.dense_dweights
+        self.dweights[...] = 0
+        self.dweights[self.dweights_rows] = rows_gradients
+        # Kept for gradient accumulation
+        self.scattered_rows = self.dweights_rows
+        self.dweights_rows = None
+
+    # Inference-only forward pass, stores nothing and writes into out when given
+    def infer(self, inputs, out=None):
+        if is_sparse(inputs):
+            if out is None:
+                out = np.empty((inputs.shape[0], self.weights.shape[1]),
+                               dtype=np.result_type(inputs.data, self.weights))
+            sparse_dot(inputs, self.weights, out)
+        else:
+            out = np.dot(inputs, self.weights, out=out)
+        out += self.biases
+        return out
+
+
+# Inference-only dense layer with int8 weights, made by Model.quantized. Weights are quantized
+# with a scale per neuron, inputs with a single scale calibrated on sample data, and the integer
+# products are scaled back to floats before the biases are added
+class Layer_Dense_Int8:
+    # Largest quantized magnitude, the range is symmetric around zero
+    LEVELS = 127
+
+    def __init__(self, dense, input_range):
+        weight_range = np.max(np.abs(dense.weights), axis=0, keepdims=True)
+        self.weight_scales = np.where(weight_range > 0, weight_range / self.LEVELS, 1.).astype(dense.weights.dtype)
+        self.quantized_weights = np.rint(dense.weights / self.weight_scales).astype(np.int8)
+        self.biases = dense.biases.copy()
+        self.input_scale = float(input_range) / self.LEVELS if input_range > 0 else 1.
+
+    def forward(self, inputs, training):
+        self.output = self.infer(inputs)
+
+    # NumPy has no fast integer matrix product, so the integers are multiplied as floats - sums of
+    # products of int8 values are exact in float32 up to 2**24, as with int32 accumulation, and
+    # wider layers accumulate in float64. The weights are converted once, on first use, and the
+    # float copy is kept next to the int8 weights, only those are saved
+    def product_weights(self):
+        weights = self.__dict__.get('float_weights')
+        if weights is None:
+            n_inputs = self.quantized_weights.shape[0]
+            dtype = np.float32 if n_inputs * self.LEVELS ** 2 <= 2 ** 24 else np.float64
+            weights = self.float_weights = self.quantized_weights.astype(dtype)
+            # Integer products back to the scale of the outputs
+            self.output_scales = (self.input_scale * self.weight_scales).astype(self.biases.dtype)
+        return weights
+
+    def infer(self, inputs, out=None):
+        if is_sparse(inputs):
+            inputs = inputs.toarray()
+        weights = self.product_weights()
+
+        quantized = np.multiply(inputs, 1 / self.input_scale, dtype=weights.dtype)
+        np.rint(quantized, out=quantized)
+        np.clip(quantized, -self.LEVELS, self.LEVELS, out=quantized)
+        products = np.dot(quantized, weights)
+
+        if out is None:
+            out = np.empty(products.shape, dtype=self.biases.dtype)
+        np.multiply(products, self.output_scales, out=out)
+        out += self.biases
+        return out
 
 
 class Layer_Dropout:
+    # Generator of the masks, a stream of its own spawned by Model.finalize
+    random = None
+
     def __init__(self, rate):
         # Store inverted rate as for dropout of 0.1 we need success rate of 0.9
         self.rate = 1 - rate
@@ -55,19 +323,341 @@ class Layer_Dropout:
         self.inputs = inputs
 
         if not training:
-            self.output = inputs.copy()
+            self.output = inputs
             return
 
-        # Generate and save scaled mask
-        self.binary_mask = np.random.binomial(
-            1, self.rate, size=inputs.shape) / self.rate
+        if self.random is None:
+            self.random = new_generator()
+
+        # Values are kept where 16 random bits are below the success rate scaled to 2**16, which is
+        # much faster than sampling a binomial distribution. Kept values are scaled by the inverse
+        # of the resulting success rate, rounded to a multiple of 2**-16
+        threshold = round(self.rate * 2**16)
+        bits = self.random.integers(0, 2**16, size=inputs.shape, dtype=np.uint16)
+
+        # Generate and save scaled mask, with a success rate of 0 (dropout of 1) nothing is kept
+        self.binary_mask = layer_buffer(self, 'binary_mask', inputs.shape, inputs.dtype)
+        if threshold == 0:
+            self.binary_mask[...] = 0
+        else:
+            np.multiply(bits < threshold, 2**16 / threshold, out=self.binary_mask)
 
         # Apply mask to output values
-        self.output = inputs * self.binary_mask
+        self.output = layer_buffer(self, 'output', inputs.shape, inputs.dtype)
+        np.multiply(inputs, self.binary_mask, out=self.output)
 
     def backward(self, dvalues):
         # Gradient on values
-        self.dinputs = dvalues * self.binary_mask
+        self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, dvalues.dtype)
+        np.multiply(dvalues, self.binary_mask, out=self.dinputs)
+
+    # Dropout is skipped entirely at inference
+    def infer(self, inputs, out=None):
+        return inputs
+
+
+# Strided view of the size x size windows of inputs of shape (samples, height, width, channels),
+# shaped (samples, out_height, out_width, size, size, channels) - no data is copied and channels
+# stay the innermost axis
+def sliding_windows(inputs, size, stride):
+    windows = np.lib.stride_tricks.sliding_window_view(inputs, (size, size), axis=(1, 2))
+    return windows[:, ::stride, ::stride].transpose(0, 1, 2, 4, 5, 3)
+
+
+# Input positions covered by kernel offset i, j in all windows - a strided view of inputs
+def window_offset(inputs, i, j, stride, out_height, out_width):
+    return inputs[:, i:i+stride*out_height:stride, j:j+stride*out_width:stride]
+
+
+# 2D convolution over inputs of shape (samples, height, width, channels). The windows are
+# copied once into a matrix with a row per output position, so forward and backward are
+# matrix products like in Layer_Dense
+class Layer_Conv2D:
+    # Initial weights are drawn from random as in Layer_Dense
+    def __init__(self, n_channels, n_filters, kernel_size, stride=1, padding=0, weight_regularizer_l1=0, weight_regularizer_l2=0, bias_regularizer_l1=0, bias_regularizer_l2=0, *, random=None):
+        # Initialize weights and biases, weights are ordered like the window axes
+        self.weights = 0.1 * (np.random if random is None else random).standard_normal(
+            (kernel_size, kernel_size, n_channels, n_filters))
+        self.biases = np.zeros((1, n_filters))
+
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+
+        # Set regularization strength
+        self.weight_regularizer_l1 = weight_regularizer_l1
+        self.weight_regularizer_l2 = weight_regularizer_l2
+        self.bias_regularizer_l1 = bias_regularizer_l1
+        self.bias_regularizer_l2 = bias_regularizer_l2
+
+    # Zero padding around the height and width axes
+    def pad(self, inputs):
+        if not self.padding:
+            return inputs
+        padding = self.padding
+        return np.pad(inputs, ((0, 0), (padding, padding), (padding, padding), (0, 0)))
+
+    def forward(self, inputs, training):
+        self.inputs = inputs
+        windows = sliding_windows(self.pad(inputs), self.kernel_size, self.stride)
+
+        # Window matrix - a row per output position, a column per weight row
+        self.columns = layer_buffer(self, 'columns', windows.shape, inputs.dtype)
+        np.copyto(self.columns, windows)
+
+        filters = self.weights.shape[-1]
+        self.output = layer_buffer(self, 'output', windows.shape[:3] + (filters,),
+                                   np.result_type(inputs, self.weights))
+        np.dot(self.columns.reshape(-1, self.weights[..., 0].size), self.weights.reshape(-1, filters),
+               out=self.output.reshape(-1, filters))
+        self.output += self.biases
+
+    def backward(self, dvalues):
+        filters = self.weights.shape[-1]
+        dvalues_rows = dvalues.reshape(-1, filters)
+        columns = self.columns.reshape(len(dvalues_rows), -1)
+
+        # Gradients on parameters - written into the existing arrays when they match,
+        # as those can be views into the model's flat gradient buffer
+        dtype = np.result_type(columns, dvalues)
+        if hasattr(self, 'dbiases') and self.dbiases.dtype == dtype:
+            np.sum(dvalues_rows, axis=0, keepdims=True, out=self.dbiases)
+        else:
+            self.dbiases = np.sum(dvalues_rows, axis=0, keepdims=True)
+
+        if hasattr(self, 'dweights') and self.dweights.shape == self.weights.shape and self.dweights.dtype == dtype:
+            np.dot(columns.T, dvalues_rows, out=self.dweights.reshape(-1, filters))
+        else:
+            self.dweights = np.dot(columns.T, dvalues_rows).reshape(self.weights.shape)
+
+        # Gradients on regularization
+        add_weight_regularization(self, self.dweights, self.weights)
+        add_bias_regularization(self)
+
+        # Gradient on values - computed one kernel offset at a time for all windows and added
+        # to the (padded) input positions that offset covers, no gradient per window is kept
+        samples, height, width, channels = self.inputs.shape
+        out_height, out_width = dvalues.shape[1:3]
+        padding = self.padding
+        dtype = np.result_type(dvalues, self.weights)
+        dpadded = layer_buffer(self, 'dpadded', (samples, height + 2 * padding, width + 2 * padding, channels), dtype)
+        dpadded[...] = 0
+        doffset = layer_buffer(self, 'doffset', (len(dvalues_rows), channels), dtype)
+
+        for i in range(self.kernel_size):
+            for j in range(self.kernel_size):
+                np.dot(dvalues_rows, self.weights[i, j].T, out=doffset)
+                window_offset(dpadded, i, j, self.stride, out_height, out_width)[...] += \
+                    doffset.reshape(samples, out_height, out_width, channels)
+
+        self.dinputs = dpadded[:, padding:padding+height, padding:padding+width] if padding else dpadded
+
+    # Inference-only forward pass, stores nothing and writes into out when given
+    def infer(self, inputs, out=None):
+        windows = sliding_windows(self.pad(inputs), self.kernel_size, self.stride)
+        filters = self.weights.shape[-1]
+        if out is None:
+            out = np.empty(windows.shape[:3] + (filters,), dtype=np.result_type(inputs, self.weights))
+        np.dot(windows.reshape(-1, self.weights[..., 0].size), self.weights.reshape(-1, filters),
+               out=out.reshape(-1, filters))
+        out += self.biases
+        return out
+
+
+# Max pooling over inputs of shape (samples, height, width, channels), stride defaults to the pool size
+class Layer_MaxPool2D:
+    def __init__(self, pool_size=2, stride=None):
+        self.pool_size = pool_size
+        self.stride = pool_size if stride is None else stride
+
+    def forward(self, inputs, training):
+        self.inputs = inputs
+        self.output = self.infer(inputs, layer_buffer(
+            self, 'output', self.output_shape(inputs), inputs.dtype))
+
+    def backward(self, dvalues):
+        windows = sliding_windows(self.inputs, self.pool_size, self.stride)
+
+        # The gradient goes to the first maximum of each window only
+        dwindows = layer_buffer(self, 'dwindows', windows.shape, dvalues.dtype)
+        found = layer_buffer(self, 'found', self.output.shape, bool)
+        maximum = layer_buffer(self, 'maximum', self.output.shape, bool)
+        found[...] = False
+        for i in range(self.pool_size):
+            for j in range(self.pool_size):
+                np.equal(windows[:, :, :, i, j], self.output, out=maximum)
+                maximum &= ~found
+                found |= maximum
+                np.multiply(dvalues, maximum, out=dwindows[:, :, :, i, j])
+
+        self.dinputs = layer_buffer(self, 'dinputs', self.inputs.shape, dvalues.dtype)
+        self.dinputs[...] = 0
+        out_height, out_width = dvalues.shape[1:3]
+        for i in range(self.pool_size):
+            for j in range(self.pool_size):
+                window_offset(self.dinputs, i, j, self.stride, out_height, out_width)[...] += dwindows[:, :, :, i, j]
+
+    def output_shape(self, inputs):
+        samples, height, width, channels = inputs.shape
+        return (samples, (height - self.pool_size) // self.stride + 1,
+                (width - self.pool_size) // self.stride + 1, channels)
+
+    def infer(self, inputs, out=None):
+        windows = sliding_windows(inputs, self.pool_size, self.stride)
+        return np.max(windows, axis=(3, 4), out=out)
+
+
+# Flattens all axes but the first, for dense layers after convolution or pooling
+class Layer_Flatten:
+    def forward(self, inputs, training):
+        self.inputs = inputs
+        self.output = inputs.reshape(len(inputs), int(np.prod(inputs.shape[1:])))
+
+    def backward(self, dvalues):
+        self.dinputs = dvalues.reshape(self.inputs.shape)
+
+    def infer(self, inputs, out=None):
+        output = inputs.reshape(len(inputs), int(np.prod(inputs.shape[1:])))
+        if out is None:
+            return output
+        np.copyto(out, output)
+        return out
+
+
+# Batch normalization - every feature (the last axis, channels of convolutions) is normalized with
+# the mean and variance of the batch in training and with running averages of them otherwise,
+# then scaled by weights (gamma) and shifted by biases (beta)
+class Layer_BatchNorm:
+    def __init__(self, n_features, momentum=0.9, epsilon=1e-5):
+        self.weights = np.ones((1, n_features))
+        self.biases = np.zeros((1, n_features))
+        self.running_mean = np.zeros((1, n_features))
+        self.running_variance = np.ones((1, n_features))
+        self.momentum = momentum
+        self.epsilon = epsilon
+
+        # Scale and shift are not regularized
+        self.weight_regularizer_l1 = 0
+        self.weight_regularizer_l2 = 0
+        self.bias_regularizer_l1 = 0
+        self.bias_regularizer_l2 = 0
+
+    def forward(self, inputs, training):
+        self.inputs = inputs
+        dtype = np.result_type(inputs, self.weights)
+        self.output = layer_buffer(self, 'output', inputs.shape, dtype)
+
+        if not training:
+            self.infer(inputs, self.output)
+            return
+
+        axes = tuple(range(inputs.ndim - 1))
+        mean = np.mean(inputs, axis=axes, keepdims=True).reshape(1, -1)
+        variance = np.var(inputs, axis=axes, keepdims=True).reshape(1, -1)
+
+        self.running_mean *= self.momentum
+        self.running_mean += (1 - self.momentum) * mean
+        self.running_variance *= self.momentum
+        self.running_variance += (1 - self.momentum) * variance
+
+        self.inverse_std = 1 / np.sqrt(variance + self.epsilon)
+        self.normalized = layer_buffer(self, 'normalized', inputs.shape, dtype)
+        np.subtract(inputs, mean, out=self.normalized)
+        self.normalized *= self.inverse_std
+
+        np.multiply(self.normalized, self.weights, out=self.output)
+        self.output += self.biases
+
+    def backward(self, dvalues):
+        axes = tuple(range(dvalues.ndim - 1))
+        samples = dvalues.size // dvalues.shape[-1]
+
+        # Gradients on parameters
+        dtype = np.result_type(dvalues, self.normalized)
+        dbiases = np.sum(dvalues, axis=axes).reshape(1, -1)
+        dweights = np.sum(dvalues * self.normalized, axis=axes).reshape(1, -1)
+        set_gradient(self, 'dbiases', dbiases)
+        set_gradient(self, 'dweights', dweights)
+
+        # Gradient on values, for all features at once -
+        # gamma / std * (dvalues - mean(dvalues) - normalized * mean(dvalues * normalized))
+        self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, dtype)
+        np.multiply(self.normalized, dweights / samples, out=self.dinputs)
+        self.dinputs += dbiases / samples
+        np.subtract(dvalues, self.dinputs, out=self.dinputs)
+        self.dinputs *= self.weights * self.inverse_std
+
+    # Scale and shift equivalent to the layer at inference
+    def scale_shift(self):
+        scale = self.weights / np.sqrt(self.running_variance + self.epsilon)
+        return scale, self.biases - self.running_mean * scale
+
+    def infer(self, inputs, out=None):
+        scale, shift = self.scale_shift()
+        out = np.multiply(inputs, scale, out=out)
+        out += shift
+        return out
+
+
+# Layer normalization - every sample is normalized over its features (the last axis),
+# then scaled by weights (gamma) and shifted by biases (beta), the same in training and inference
+class Layer_LayerNorm:
+    def __init__(self, n_features, epsilon=1e-5):
+        self.weights = np.ones((1, n_features))
+        self.biases = np.zeros((1, n_features))
+        self.epsilon = epsilon
+
+        # Scale and shift are not regularized
+        self.weight_regularizer_l1 = 0
+        self.weight_regularizer_l2 = 0
+        self.bias_regularizer_l1 = 0
+        self.bias_regularizer_l2 = 0
+
+    # Normalized inputs written into out, returns them and the inverse standard deviations
+    def normalize(self, inputs, out):
+        mean = np.mean(inputs, axis=-1, keepdims=True)
+        inverse_std = 1 / np.sqrt(np.var(inputs, axis=-1, keepdims=True) + self.epsilon)
+        np.subtract(inputs, mean, out=out)
+        out *= inverse_std
+        return out, inverse_std
+
+    def forward(self, inputs, training):
+        self.inputs = inputs
+        dtype = np.result_type(inputs, self.weights)
+        self.normalized, self.inverse_std = self.normalize(
+            inputs, layer_buffer(self, 'normalized', inputs.shape, dtype))
+
+        self.output = layer_buffer(self, 'output', inputs.shape, dtype)
+        np.multiply(self.normalized, self.weights, out=self.output)
+        self.output += self.biases
+
+    def backward(self, dvalues):
+        axes = tuple(range(dvalues.ndim - 1))
+
+        # Gradients on parameters
+        dtype = np.result_type(dvalues, self.normalized)
+        dbiases = np.sum(dvalues, axis=axes).reshape(1, -1)
+        dweights = np.sum(dvalues * self.normalized, axis=axes).reshape(1, -1)
+        set_gradient(self, 'dbiases', dbiases)
+        set_gradient(self, 'dweights', dweights)
+
+        # Gradient on values, for all samples at once -
+        # 1 / std * (d - mean(d) - normalized * mean(d * normalized)) with d = dvalues * gamma
+        self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, dtype)
+        np.multiply(dvalues, self.weights, out=self.dinputs)
+        dnormalized_mean = np.mean(self.dinputs, axis=-1, keepdims=True)
+        projection = np.mean(self.dinputs * self.normalized, axis=-1, keepdims=True)
+        self.dinputs -= dnormalized_mean
+        self.dinputs -= self.normalized * projection
+        self.dinputs *= self.inverse_std
+
+    def infer(self, inputs, out=None):
+        if out is None:
+            out = np.empty(inputs.shape, dtype=np.result_type(inputs, self.weights))
+        self.normalize(inputs, out)
+        out *= self.weights
+        out += self.biases
+        return out
 
 
 class Layer_Input:
@@ -78,13 +668,20 @@ class Layer_Input:
 class Activation_ReLU:
     def forward(self, inputs, training):
         self.inputs = inputs
-        self.output = np.maximum(0, inputs)
+        self.output = layer_buffer(self, 'output', inputs.shape, inputs.dtype)
+        np.maximum(0, inputs, out=self.output)
 
     def backward(self, dvalues):
-        self.dinputs = dvalues.copy()
+        self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, dvalues.dtype)
+        np.copyto(self.dinputs, dvalues)
 
-        # Zero gradient where input values are nega1.82tive
-        self.dinputs[self.inputs <= 0] = 0
+        # Zero gradient where input values are negative
+        negative = layer_buffer(self, 'negative', self.inputs.shape, bool)
+        np.less_equal(self.inputs, 0, out=negative)
+        np.putmask(self.dinputs, negative, 0)
+
+    def infer(self, inputs, out=None):
+        return np.maximum(inputs, 0, out=out)
 
     def predictions(self, outputs):
         return outputs
@@ -94,24 +691,26 @@ class Activation_Softmax:
     def forward(self, inputs, training):
         self.inputs = inputs
 
-        exp_values = np.exp(inputs - np.max(inputs, axis=1, keepdims=True))
-        probabilites = exp_values / np.sum(exp_values, axis=1, keepdims=True)
-        self.output = probabilites
+        # Exponentials of shifted values, normalized in place
+        self.output = layer_buffer(self, 'output', inputs.shape, inputs.dtype)
+        np.subtract(inputs, np.max(inputs, axis=1, keepdims=True), out=self.output)
+        np.exp(self.output, out=self.output)
+        self.output /= np.sum(self.output, axis=1, keepdims=True)
 
     def backward(self, dvalues):
-        # Create uninitialized array
-        self.dinputs = np.empty_like(dvalues)
-
-        for index, (single_output, single_dvalues) in enumerate(zip(self.output, dvalues)):
-            # Flatten output array
-            single_output = single_output.reshape(-1, 1)
-
-            # Calculate Jacobian matrix of the output and
-            jacobian_matrix = np.diagflat(
-                single_output) - np.dot(single_output, single_output.T)
-
-            # Calculate sample-wise gradient and add it to the array of sample gradients
-            self.dinputs[index] = np.dot(jacobian_matrix, single_dvalues)
+        # Jacobian-vector product for the whole batch at once:
+        # (diag(s) - s s^T) @ d = s * (d - s . d)
+        self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, dvalues.dtype)
+        np.multiply(self.output, dvalues, out=self.dinputs)
+        dot_products = np.sum(self.dinputs, axis=1, keepdims=True)
+        np.subtract(dvalues, dot_products, out=self.dinputs)
+        self.dinputs *= self.output
+
+    def infer(self, inputs, out=None):
+        out = np.subtract(inputs, np.max(inputs, axis=1, keepdims=True), out=out)
+        np.exp(out, out=out)
+        out /= np.sum(out, axis=1, keepdims=True)
+        return out
 
     def predictions(self, outputs):
         return np.argmax(outputs, axis=1)
@@ -122,11 +721,22 @@ class Activation_Sigmoid:
         self.inputs = inputs
 
         # Sigmoid function
-        self.output = 1 / (1 + np.exp(-inputs))
+        self.output = self.infer(inputs, layer_buffer(self, 'output', inputs.shape, inputs.dtype))
 
     def backward(self, dvalues):
         # Derivative - calculates from output of the sigmoid function
-        self.dinputs = dvalues * (1 - self.output) * self.output
+        self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, dvalues.dtype)
+        np.subtract(1, self.output, out=self.dinputs)
+        np.multiply(dvalues, self.dinputs, out=self.dinputs)
+        self.dinputs *= self.output
+
+    def infer(self, inputs, out=None):
+        # 1 / (1 + exp(-x)) computed in place
+        out = np.negative(inputs, out=out)
+        np.exp(out, out=out)
+        out += 1
+        np.reciprocal(out, out=out)
+        return out
 
     def predictions(self, outputs):
         return (outputs > 0.5) * 1
@@ -138,31 +748,96 @@ class Activation_Linear:
         self.output = inputs
 
     def backward(self, dvalues):
-        # Derivative of y=x, is 1
-        self.dinputs = dvalues.copy()
+        # Derivative of y=x, is 1 - with reused buffers gradients are passed on without a copy
+        if getattr(self, 'reuse_buffers', False):
+            self.dinputs = dvalues
+        else:
+            self.dinputs = dvalues.copy()
+
+    def infer(self, inputs, out=None):
+        if out is None:
+            return inputs
+        np.copyto(out, inputs)
+        return out
 
     def predictions(self, outputs):
         return outputs
 
 
+# Dense layer and the activation after it in one object, set up by Model.finalize. Parameters
+# and gradients stay on the dense layer, the activation runs in place on the dense output
+# and its derivative in place on the incoming gradient
+class Layer_Dense_Activation_ReLU:
+    def __init__(self, dense, activation):
+        self.dense = dense
+        self.activation = activation
+
+    def forward(self, inputs, training):
+        self.dense.forward(inputs, training)
+        self.output = self.activation.output = self.dense.output
+        np.maximum(self.output, 0, out=self.output)
+
+    def backward(self, dvalues):
+        # Zero gradient where values were negative - outputs are zero exactly there
+        negative = layer_buffer(self, 'negative', self.output.shape, bool)
+        np.less_equal(self.output, 0, out=negative)
+        np.putmask(dvalues, negative, 0)
+
+        self.dense.backward(dvalues)
+        self.dinputs = self.dense.dinputs
+
+    def infer(self, inputs, out=None):
+        out = self.dense.infer(inputs, out)
+        return np.maximum(out, 0, out=out)
+
+
+class Layer_Dense_Activation_Sigmoid:
+    def __init__(self, dense, activation):
+        self.dense = dense
+        self.activation = activation
+
+    def forward(self, inputs, training):
+        self.dense.forward(inputs, training)
+        self.output = self.activation.output = self.activation.infer(self.dense.output, self.dense.output)
+
+    def backward(self, dvalues):
+        # Derivative - calculates from output of the sigmoid function
+        derivative = layer_buffer(self, 'derivative', self.output.shape, self.output.dtype)
+        np.subtract(1, self.output, out=derivative)
+        dvalues *= derivative
+        dvalues *= self.output
+
+        self.dense.backward(dvalues)
+        self.dinputs = self.dense.dinputs
+
+    def infer(self, inputs, out=None):
+        out = self.dense.infer(inputs, out)
+        return self.activation.infer(out, out)
+
+
 class Activation_Softmax_Loss_CategoricalCrossentropy():
     def backward(self, dvalues, y_true):
         samples = len(dvalues)
 
-        # If labels are one-hot encoded, turn them into discrete values
-        if len(y_true.shape) == 2:
-            y_true = np.argmax(y_true, axis=1)
+        self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, dvalues.dtype)
 
-        self.dinputs = dvalues.copy()
-
-        # Calculate gradient
-        self.dinputs[range(samples), y_true] -= 1
+        # Calculate gradient - with 2D targets (one-hot or soft) it is outputs minus targets,
+        # with class indices 1 is subtracted at the correct classes
+        if len(y_true.shape) == 2:
+            np.subtract(dvalues, y_true, out=self.dinputs)
+        else:
+            np.copyto(self.dinputs, dvalues)
+            self.dinputs[np.arange(samples), y_true] -= 1
 
         # Normalize gradient
-        self.dinputs = self.dinputs / samples
+        self.dinputs /= samples
 
 
 class Loss:
+    # Accumulated over steps, reset by new_pass
+    accumulated_sum = 0
+    accumulated_count = 0
+
     def regularization_loss(self):
         regularization_loss = 0
 
@@ -197,11 +872,29 @@ class Loss:
         sample_losses = self.forward(output, y)
         data_loss = np.mean(sample_losses)
 
+        # Add accumulated sum of losses and sample count
+        self.accumulated_sum += np.sum(sample_losses)
+        self.accumulated_count += len(sample_losses)
+
         if not include_regularization:
             return data_loss
 
         return data_loss, self.regularization_loss()
 
+    # Calculates accumulated loss over all steps since the last new_pass
+    def calculate_accumulated(self, *, include_regularization=False):
+        data_loss = self.accumulated_sum / self.accumulated_count
+
+        if not include_regularization:
+            return data_loss
+
+        return data_loss, self.regularization_loss()
+
+    # Reset variables for accumulated loss
+    def new_pass(self):
+        self.accumulated_sum = 0
+        self.accumulated_count = 0
+
 
 class Loss_MeanSquaredError(Loss):
     def forward(self, y_pred, y_true):
@@ -213,10 +906,13 @@ class Loss_MeanSquaredError(Loss):
         outputs = len(dvalues[0])
 
         # Gradient on values
-        self.dinputs = -2 * (y_true - dvalues) / outputs
+        self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, np.result_type(dvalues, y_true))
+        np.subtract(y_true, dvalues, out=self.dinputs)
+        self.dinputs *= -2
+        self.dinputs /= outputs
 
         # Normalize gradient
-        self.dinputs = self.dinputs / samples
+        self.dinputs /= samples
 
 
 class Loss_MeanAbsoluteError(Loss):
@@ -229,10 +925,13 @@ class Loss_MeanAbsoluteError(Loss):
         outputs = len(dvalues[0])
 
         # Calculate gradient
-        self.dinputs = np.sign(dvalues - y_true) / outputs
+        self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, np.result_type(dvalues, y_true))
+        np.subtract(dvalues, y_true, out=self.dinputs)
+        np.sign(self.dinputs, out=self.dinputs)
+        self.dinputs /= outputs
 
         # Normalize gradient
-        self.dinputs = self.dinputs / samples
+        self.dinputs /= samples
 
 
 class Loss_BinaryCrossentropy(Loss):
@@ -251,28 +950,38 @@ class Loss_BinaryCrossentropy(Loss):
         samples = len(dvalues)
         outputs = len(dvalues[0])
 
+        dtype = np.result_type(dvalues, y_true)
+        self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, dtype)
+        clipped_dvalues = layer_buffer(self, 'clipped', dvalues.shape, dvalues.dtype)
+        negatives = layer_buffer(self, 'negatives', dvalues.shape, dtype)
+
         # Clip data to prevent division by 0
-        clipped_dvalues = np.clip(dvalues, 1e-7, 1 - 1e-7)
+        np.clip(dvalues, 1e-7, 1 - 1e-7, out=clipped_dvalues)
 
-        # Calculate gradient
-        self.dinputs = -(y_true / clipped_dvalues -
-                         (1 - y_true) / (1 - clipped_dvalues)) / outputs
+        # Calculate gradient - -(y / p - (1 - y) / (1 - p)) / outputs
+        np.divide(y_true, clipped_dvalues, out=self.dinputs)
+        np.subtract(1, clipped_dvalues, out=clipped_dvalues)
+        np.subtract(1, y_true, out=negatives)
+        np.divide(negatives, clipped_dvalues, out=negatives)
+        np.subtract(self.dinputs, negatives, out=self.dinputs)
+        np.negative(self.dinputs, out=self.dinputs)
+        self.dinputs /= outputs
 
         # Normalize gradient, so not influenced on number of samples
-        self.dinputs = self.dinputs / samples
+        self.dinputs /= samples
 
 
 class Loss_CategoricalCrossentropy(Loss):
     def forward(self, y_pred, y_true):
         samples = len(y_pred)
-        y_pred_clipped = np.clip(y_pred, 1e-7, 1 - 1e-7)
 
-        # Scalar
+        # Scalar - only the confidences of the correct classes are picked and clipped
         if len(y_true.shape) == 1:
-            correct_confidences = y_pred_clipped[range(samples), y_true]
+            correct_confidences = np.clip(y_pred[np.arange(samples), y_true], 1e-7, 1 - 1e-7)
 
         # One Hot
         elif len(y_true.shape) == 2:
+            y_pred_clipped = np.clip(y_pred, 1e-7, 1 - 1e-7)
             correct_confidences = np.sum(y_pred_clipped * y_true, axis=1)
 
         negative_log_likelihoods = -np.log(correct_confidences)
@@ -280,26 +989,28 @@ class Loss_CategoricalCrossentropy(Loss):
 
     def backward(self, dvalues, y_true):
         samples = len(dvalues)
-        labels = len(dvalues[0])
 
-        # If labels are sparse, turn them into one-hot vector
+        # Sparse labels - the gradient -y_true / dvalues is nonzero only at the correct
+        # classes, so it is set there by index without building one-hot vectors
         if len(y_true.shape) == 1:
-            y_true = np.eye(labels)[y_true]
+            self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, dvalues.dtype)
+            self.dinputs[...] = 0
+            rows = np.arange(samples)
+            self.dinputs[rows, y_true] = -1 / dvalues[rows, y_true]
 
         # Calculate gradient
-        self.dinputs = -y_true / dvalues
+        else:
+            self.dinputs = layer_buffer(self, 'dinputs', dvalues.shape, np.result_type(dvalues, y_true))
+            np.negative(y_true, out=self.dinputs)
+            self.dinputs /= dvalues
 
         # Normalize gradient
-        self.dinputs = self.dinputs / samples
+        self.dinputs /= samples
 
 
-class Optimizer_SGD:
-    def __init__(self, learning_rate=1.0, decay=0.0, momentum=0.0):
-        self.learning_rate = learning_rate
-        self.current_learning_rate = learning_rate
-        self.decay = decay
-        self.momentum = momentum
-        self.iterations = 0
+class Optimizer:
+    # Scratch arrays are kept between steps
+    reuse_buffers = True
 
     # Call once before any parameter updates
     def pre_update_params(self):
@@ -307,43 +1018,78 @@ class Optimizer_SGD:
             self.current_learning_rate = self.learning_rate * \
                 (1. / (1. + self.decay * self.iterations))
 
-    # Update parameters
-    def update_params(self, layer):
-        layer.weights += -self.current_learning_rate * layer.dweights
-        layer.biases += -self.current_learning_rate * layer.dbiases
+    # Call once after any parameter updates
+    def post_update_params(self):
+        self.iterations += 1
+
+    # Optimizer state arrays of a layer for weights or biases, in the order update takes them
+    def state(self, layer, prefix):
+        return [getattr(layer, f'{prefix}_{name}') for name in self.state_names]
 
     def update_params(self, layer):
+        # If layer does not contain state arrays, create them filled with zeros
+        if self.state_names and not hasattr(layer, f'weight_{self.state_names[-1]}'):
+            self.init_state(layer)
+
+        rows = getattr(layer, 'dweights_rows', None)
+        if rows is None:
+            self.update(layer.weights, layer.dweights, *self.state(layer, 'weight'))
+        else:
+            # Lazy update of row-sparse gradients - only the touched weight rows and their
+            # state are gathered, updated and written back
+            weights = layer.weights[rows]
+            state = [array[rows] for array in self.state(layer, 'weight')]
+            self.update(weights, layer.dweights, *state)
+            layer.weights[rows] = weights
+            for array, rows_state in zip(self.state(layer, 'weight'), state):
+                array[rows] = rows_state
+
+        self.update(layer.biases, layer.dbiases, *self.state(layer, 'bias'))
+
+    # Scratch arrays for intermediate results shared by all layers, reused for
+    # arrays with the same trailing shape and dtype and grown when more rows are needed
+    def scratch(self, like, index=0):
+        return layer_buffer(self, (index, like.shape[1:], like.dtype.str), like.shape, like.dtype)
+
+
+class Optimizer_SGD(Optimizer):
+    def __init__(self, learning_rate=1.0, decay=0.0, momentum=0.0):
+        self.learning_rate = learning_rate
+        self.current_learning_rate = learning_rate
+        self.decay = decay
+        self.momentum = momentum
+        self.iterations = 0
+
+    @property
+    def state_names(self):
+        return ('momentums',) if self.momentum else ()
+
+    # Create momentum arrays filled with zeros
+    def init_state(self, layer):
         if self.momentum:
-            # If layer does not contain momentum arrays, create them filled with zeros
-            if not hasattr(layer, 'weight_momentums'):
-                layer.weight_momentums = np.zeros_like(layer.weights)
-                layer.bias_momentums = np.zeros_like(layer.biases)
+            layer.weight_momentums = np.zeros_like(layer.weights)
+            layer.bias_momentums = np.zeros_like(layer.biases)
 
-            # Build weight updates with momentum - take previous updates multiplied by retain factor and update with current gradients
-            weight_updates = self.momentum * layer.weight_momentums - \
-                self.current_learning_rate * layer.dweights
-            layer.weight_momentums = weight_updates
+    # Updates parameters in place
+    def update(self, params, dparams, momentums=None):
+        updates = self.scratch(params)
 
-            # Build bias updates
-            bias_updates = self.momentum * layer.bias_momentums - \
-                self.current_learning_rate * layer.dbiases
-            layer.bias_momentums = bias_updates
+        if self.momentum:
+            # Take previous updates multiplied by retain factor and update with current gradients
+            np.multiply(self.current_learning_rate, dparams, out=updates)
+            momentums *= self.momentum
+            momentums -= updates
+            params += momentums
 
         # Vanilla SGD updates
         else:
-            weight_updates = -self.current_learning_rate * layer.dweights
-            bias_updates = -self.current_learning_rate * layer.dbiases
-
-        # Update weights and biases using either vanilla or momentum updates
-        layer.weights += weight_updates
-        layer.biases += bias_updates
+            np.multiply(-self.current_learning_rate, dparams, out=updates)
+            params += updates
 
-    # Call once after any parameter updates
-    def post_update_params(self):
-        self.iterations += 1
 
+class Optimizer_Adagrad(Optimizer):
+    state_names = ('cache',)
 
-class Optimizer_Adagrad:
     def __init__(self, learning_rate=1., decay=0., epsilon=1e-7):
         self.learning_rate = learning_rate
         self.current_learning_rate = learning_rate
@@ -351,34 +1097,31 @@ class Optimizer_Adagrad:
         self.iterations = 0
         self.epsilon = epsilon
 
-    # Call once before any parameter updates
-    def pre_update_params(self):
-        if self.decay:
-            self.current_learning_rate = self.learning_rate * \
-                (1. / (1. + self.decay * self.iterations))
+    # Create cache arrays filled with zeros
+    def init_state(self, layer):
+        layer.weight_cache = np.zeros_like(layer.weights)
+        layer.bias_cache = np.zeros_like(layer.biases)
 
-    def update_params(self, layer):
-        # If layer does not contain cache arrays, create them filled with zeros
-        if not hasattr(layer, 'weight_cache'):
-            layer.weight_cache = np.zeros_like(layer.weights)
-            layer.bias_cache = np.zeros_like(layer.biases)
+    # Updates parameters in place
+    def update(self, params, dparams, cache):
+        updates = self.scratch(params)
+        denominators = self.scratch(params, 1)
 
         # Update cache with squared current gradients
-        layer.weight_cache += layer.dweights ** 2
-        layer.bias_cache += layer.dbiases ** 2
+        np.square(dparams, out=updates)
+        cache += updates
 
         # Vanilla SGD parameter update + normalization with square rooted cache
-        layer.weights += -self.current_learning_rate * \
-            layer.dweights / (np.sqrt(layer.weight_cache) + self.epsilon)
-        layer.biases += -self.current_learning_rate * \
-            layer.dbiases / (np.sqrt(layer.bias_cache) + self.epsilon)
+        np.sqrt(cache, out=denominators)
+        denominators += self.epsilon
+        np.multiply(-self.current_learning_rate, dparams, out=updates)
+        updates /= denominators
+        params += updates
 
-    # Call once after any parameter updates
-    def Post_update_params(self):
-        self.iterations += 1
 
+class Optimizer_RMSprop(Optimizer):
+    state_names = ('cache',)
 
-class Optimizer_RMSprop:
     def __init__(self, learning_rate=0.001, decay=0., epsilon=1e-7, rho=0.9):
         self.learning_rate = learning_rate
         self.current_learning_rate = learning_rate
@@ -387,36 +1130,33 @@ class Optimizer_RMSprop:
         self.epsilon = epsilon
         self.rho = rho
 
-    # Call once before any parameter updates
-    def pre_update_params(self):
-        if self.decay:
-            self.current_learning_rate = self.learning_rate * \
-                (1. / (1. + self.decay * self.iterations))
+    # Create cache arrays filled with zeros
+    def init_state(self, layer):
+        layer.weight_cache = np.zeros_like(layer.weights)
+        layer.bias_cache = np.zeros_like(layer.biases)
 
-    def update_params(self, layer):
-        # If layer does not contain cache arrays, create them filled with zeros
-        if not hasattr(layer, 'weight_cache'):
-            layer.weight_cache = np.zeros_like(layer.weights)
-            layer.bias_cache = np.zeros_like(layer.biases)
+    # Updates parameters in place
+    def update(self, params, dparams, cache):
+        updates = self.scratch(params)
+        denominators = self.scratch(params, 1)
 
         # Update cache with squared current gradients
-        layer.weight_cache = self.rho * layer.weight_cache + \
-            (1 - self.rho) * layer.dweights**2
-        layer.bias_cache = self.rho * layer.bias_cache + \
-            (1 - self.rho) * layer.dbiases**2
+        np.square(dparams, out=updates)
+        updates *= 1 - self.rho
+        cache *= self.rho
+        cache += updates
 
         # Vanilla SGD parameter update + normalization with square rooted cache
-        layer.weights += -self.current_learning_rate * \
-            layer.dweights / (np.sqrt(layer.weight_cache) + self.epsilon)
-        layer.biases += -self.current_learning_rate * \
-            layer.dbiases / (np.sqrt(layer.bias_cache) + self.epsilon)
+        np.sqrt(cache, out=denominators)
+        denominators += self.epsilon
+        np.multiply(-self.current_learning_rate, dparams, out=updates)
+        updates /= denominators
+        params += updates
 
-    # Call once after any parameter updates
-    def post_update_params(self):
-        self.iterations += 1
 
+class Optimizer_Adam(Optimizer):
+    state_names = ('momentums', 'cache')
 
-class Optimizer_Adam:
     def __init__(self, learning_rate=0.001, decay=0.0, epsilon=1e-7, beta_1=0.9, beta_2=0.999):
         self.learning_rate = learning_rate
         self.current_learning_rate = learning_rate
@@ -426,65 +1166,127 @@ class Optimizer_Adam:
         self.beta_1 = beta_1
         self.beta_2 = beta_2
 
-    # Call once before any parameter updates
-    def pre_update_params(self):
-        if self.decay:
-            self.current_learning_rate = self.learning_rate * \
-                (1. / (1. + self.decay * self.iterations))
+    # Create momentum and cache arrays filled with zeros
+    def init_state(self, layer):
+        layer.weight_momentums = np.zeros_like(layer.weights)
+        layer.weight_cache = np.zeros_like(layer.weights)
+        layer.bias_momentums = np.zeros_like(layer.biases)
+        layer.bias_cache = np.zeros_like(layer.biases)
 
-    def update_params(self, layer):
-        # If layer does not contain cache arrays, create them filled with zeros
-        if not hasattr(layer, 'weight_cache'):
-            layer.weight_momentums = np.zeros_like(layer.weights)
-            layer.weight_cache = np.zeros_like(layer.weights)
-            layer.bias_momentums = np.zeros_like(layer.biases)
-            layer.bias_cache = np.zeros_like(layer.biases)
+    # Updates parameters in place
+    def update(self, params, dparams, momentums, cache):
+        updates = self.scratch(params)
+        denominators = self.scratch(params, 1)
 
         # Update momentum with current gradients
-        layer.weight_momentums = self.beta_1 * \
-            layer.weight_momentums + (1 - self.beta_1) * layer.dweights
-        layer.bias_momentums = self.beta_1 * \
-            layer.bias_momentums + (1 - self.beta_1) * layer.dbiases
-
-        # Get corrected momentum self.iteration is 0 at first pass and need to start with 1 here
-        weight_momentums_corrected = layer.weight_momentums / \
-            (1 - self.beta_1 ** (self.iterations + 1))
-        bias_momentums_corrected = layer.bias_momentums / \
-            (1 - self.beta_1 ** (self.iterations + 1))
+        np.multiply(1 - self.beta_1, dparams, out=updates)
+        momentums *= self.beta_1
+        momentums += updates
 
         # Update cache with squared current gradients
-        layer.weight_cache = self.beta_2 * layer.weight_cache + \
-            (1 - self.beta_2) * layer.dweights**2
-        layer.bias_cache = self.beta_2 * layer.bias_cache + \
-            (1 - self.beta_2) * layer.dbiases**2
+        np.square(dparams, out=denominators)
+        denominators *= 1 - self.beta_2
+        cache *= self.beta_2
+        cache += denominators
 
-        # Get corrected cache
-        weight_cache_corrected = layer.weight_cache / \
-            (1 - self.beta_2 ** (self.iterations + 1))
-        bias_cache_corrected = layer.bias_cache / \
-            (1 - self.beta_2 ** (self.iterations + 1))
+        # Get corrected momentum and cache, self.iterations is 0 at first pass and need to start with 1 here
+        np.divide(momentums, 1 - self.beta_1 ** (self.iterations + 1), out=updates)
+        np.divide(cache, 1 - self.beta_2 ** (self.iterations + 1), out=denominators)
 
         # Vanilla SGD parameter update + normalization with square rooted cache
-        layer.weights += -self.current_learning_rate * weight_momentums_corrected / \
-            (np.sqrt(weight_cache_corrected) + self.epsilon)
-        layer.biases += -self.current_learning_rate * bias_momentums_corrected / \
-            (np.sqrt(bias_cache_corrected) + self.epsilon)
+        np.sqrt(denominators, out=denominators)
+        denominators += self.epsilon
+        updates *= -self.current_learning_rate
+        updates /= denominators
+        params += updates
+
+
+# Parameters, gradients and optimizer state of all trainable layers in contiguous flat arrays,
+# the layers keep views into them. Looks like a single layer to optimizers, with all
+# parameters in weights, so one update_params call updates the whole model.
+class Parameters_Flat:
+    # Flat array name and the layer weight and bias attributes stored in it
+    GROUPS = (('weights', 'weights', 'biases'),
+              ('dweights', 'dweights', 'dbiases'),
+              ('master_weights', 'master_weights', 'master_biases'),
+              ('weight_momentums', 'weight_momentums', 'bias_momentums'),
+              ('weight_cache', 'weight_cache', 'bias_cache'))
+
+    def __init__(self, layers, optimizer, update_dtype):
+        self.layers = layers
+
+        self.group('weights')
+        if hasattr(layers[0], 'master_weights'):
+            self.group('master_weights')
+        self.group('dweights', np.zeros_like(self.weights))
+
+        # Row-sparse gradients of sparse inputs are written into the flat views instead
+        for layer in layers:
+            layer.dense_gradients = True
+
+        # Optimizer state in the dtype updates are made in, values the layers already have are kept
+        optimizer.init_state(self)
+        for flat_name, weight_name, bias_name in self.GROUPS[3:]:
+            if hasattr(self, flat_name):
+                self.group(flat_name, np.zeros(self.weights.shape, dtype=update_dtype))
+
+    # Creates a flat array for a group, copies layer values into it and replaces them with views
+    def group(self, flat_name, flat=None):
+        _, weight_name, bias_name = next(group for group in self.GROUPS if group[0] == flat_name)
+
+        if flat is None:
+            dtype = getattr(self.layers[0], weight_name).dtype
+            flat = np.empty(sum(layer.weights.size + layer.biases.size
+                                for layer in self.layers), dtype=dtype)
+
+        offset = 0
+        for layer in self.layers:
+            for name, shape in ((weight_name, layer.weights.shape), (bias_name, layer.biases.shape)):
+                size = int(np.prod(shape))
+                view = flat[offset:offset+size].reshape(shape)
+                if hasattr(layer, name) and getattr(layer, name).shape == shape:
+                    view[...] = getattr(layer, name)
+                setattr(layer, name, view)
+                offset += size
 
-    # Call once after any parameter updates
-    def post_update_params(self):
-        self.iterations += 1
+            # Dense gradient views, used by layers with row-sparse gradients
+            if flat_name == 'dweights':
+                layer.dense_dweights = layer.dweights
+
+        # All values are in the weight side, the bias side is empty
+        setattr(self, flat_name, flat)
+        setattr(self, bias_name, flat[:0])
 
 
 class Accuracy:
+    # Accumulated over steps, reset by new_pass
+    accumulated_sum = 0
+    accumulated_count = 0
+
     # Calculates an accuracy given predictions and ground truth values
     def calculate(self, predictions, y):
         # Get comparison results
         comparisons = self.compare(predictions, y)
         # Calculate an accuracy
         accuracy = np.mean(comparisons)
+
+        # Add accumulated sum of matching values and sample count
+        self.accumulated_sum += np.sum(comparisons)
+        self.accumulated_count += comparisons.size
+
         # Return accuracy
         return accuracy
 
+    # Calculates accumulated accuracy over all steps since the last new_pass
+    def calculate_accumulated(self):
+        accuracy = self.accumulated_sum / self.accumulated_count
+        return accuracy
+
+    # Reset variables for accumulated accuracy
+    def new_pass(self):
+        self.accumulated_sum = 0
+        self.accumulated_count = 0
+
 # Accuracy calculation for classification model
 
 
@@ -515,12 +1317,466 @@ class Accuracy_Regression(Accuracy):
         return np.absolute(predictions - y) < self.precision
 
 
+# Generator a shuffle argument of Data refers to - itself, or the global random state for True
+def shuffler(shuffle):
+    return shuffle if isinstance(shuffle, np.random.Generator) else np.random
+
+
+# Base class for data sources yielding (X, y) chunks that Model.train consumes in batches
+class Data:
+    # Number of chunks loaded ahead on a background thread
+    prefetch = 1
+
+    # Ground truth values used to initialize accuracy objects
+    def init_y(self):
+        return self.y
+
+    # Yields batches, chunk by chunk, with the next chunk loaded while the current one is used.
+    # shuffle can be a NumPy Generator to shuffle with, True uses the global random state
+    def batches(self, batch_size=None, *, shuffle=False):
+        for X, y in self.prefetched(self.chunks(shuffle=shuffle)):
+            samples = X.shape[0]
+            size = samples if batch_size is None else batch_size
+
+            if not shuffle or samples <= size:
+                for start in range(0, samples, size):
+                    yield X[start:start+size], y[start:start+size]
+                continue
+
+            # Permutation buffer reused and reshuffled in place for chunks of the same length
+            if getattr(self, 'permutation', None) is None or len(self.permutation) != samples:
+                self.permutation = np.arange(samples)
+            shuffler(shuffle).shuffle(self.permutation)
+
+            # Only the rows of the current batch are gathered
+            for start in range(0, samples, size):
+                batch_indices = self.permutation[start:start+size]
+                yield X[batch_indices], y[batch_indices]
+
+    # Runs an iterable of chunks on a background thread and yields its items
+    def prefetched(self, chunks):
+        if not self.prefetch:
+            yield from chunks
+            return
+
+        buffer = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def producer():
+            try:
+                for chunk in chunks:
+                    if not put(chunk):
+                        return
+            except BaseException as exception:
+                # Re-raised in the consuming thread
+                put((end, exception))
+                return
+            put((end, None))
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = buffer.get()
+                if item[0] is end:
+                    if item[1] is not None:
+                        raise item[1]
+                    return
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
+# Arrays held in memory - a single chunk, no background loading needed
+class Data_Array(Data):
+    prefetch = 0
+
+    def __init__(self, X, y):
+        self.X = X
+        self.y = y
+
+    def chunks(self, shuffle=False):
+        yield self.X, self.y
+
+
+# Arrays saved with np.save, memory-mapped and read from disk chunk by chunk
+class Data_Npy(Data):
+    def __init__(self, X_path, y_path, *, chunk_size=65536):
+        self.X = np.load(X_path, mmap_mode='r')
+        self.y = np.load(y_path, mmap_mode='r')
+        self.chunk_size = chunk_size
+
+    def chunks(self, shuffle=False):
+        starts = np.arange(0, len(self.X), self.chunk_size)
+
+        # Visit chunks in random order, rows are shuffled within each chunk
+        if shuffle:
+            shuffler(shuffle).shuffle(starts)
+
+        for start in starts:
+            end = start + self.chunk_size
+            # Copy chunk into memory, this is what runs ahead on the background thread
+            yield np.array(self.X[start:end]), np.array(self.y[start:end])
+
+
+# Chunks from an iterable of (X, y) pairs or a callable returning one (e.g. a generator function)
+class Data_Iterator(Data):
+    def __init__(self, chunks):
+        self.source = chunks
+        # Iterators such as generator objects can be read only once
+        self.one_shot = not callable(chunks) and iter(chunks) is chunks
+        # First chunk of a one-shot iterator, taken by init_y and yielded first by chunks
+        self.first_chunk = None
+
+    def init_y(self):
+        # Only the first chunk is available up front
+        if self.one_shot:
+            if self.first_chunk is None:
+                self.first_chunk = next(self.source, None)
+            return None if self.first_chunk is None else self.first_chunk[1]
+        for X, y in self.chunks():
+            return y
+
+    def chunks(self, shuffle=False):
+        # Callables are called again every pass, plain iterables are iterated again
+        if callable(self.source):
+            return iter(self.source())
+        if self.first_chunk is not None:
+            first_chunk, self.first_chunk = self.first_chunk, None
+            return itertools.chain([first_chunk], self.source)
+        return iter(self.source)
+
+
+# Worker process of Pool_DataParallel - runs forward and backward passes of a model replica
+# on its share of each batch, reading parameters from and writing gradients to shared memory
+def data_parallel_worker(model, rank, workers, connection, parameters_name, gradients_name, random):
+    # The replica's dropout layers get streams spawned from the worker's own, so no two
+    # workers draw the same masks
+    model.random = random
+    for layer in model.layers:
+        if hasattr(layer, 'random'):
+            layer.random = random.spawn(1)[0]
+
+    flat = model.parameters
+    size = flat.weights.size
+
+    # Parameters are shared by all processes, every worker has its own row of gradients
+    parameters_memory = shared_memory.SharedMemory(name=parameters_name)
+    gradients_memory = shared_memory.SharedMemory(name=gradients_name)
+    flat.group('weights', np.ndarray(size, dtype=flat.weights.dtype, buffer=parameters_memory.buf))
+    flat.group('dweights', np.ndarray((workers, size), dtype=flat.dweights.dtype,
+                                      buffer=gradients_memory.buf)[rank])
+
+    batch_memory = {}
+
+    def attach(name, shape, dtype):
+        if name not in batch_memory:
+            batch_memory[name] = shared_memory.SharedMemory(name=name)
+        return np.ndarray(shape, dtype=dtype, buffer=batch_memory[name].buf)
+
+    try:
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+
+            X_spec, y_spec, rows = message
+            X = attach(*X_spec)[:rows]
+            y = attach(*y_spec)[:rows]
+
+            # Contiguous share of the batch for this worker
+            start = rows * rank // workers
+            end = rows * (rank + 1) // workers
+            X = X[start:end]
+            y = y[start:end]
+
+            if not len(X):
+                flat.dweights[...] = 0
+                connection.send((0, 0, 0, 0))
+                continue
+
+            output = model.forward(X, training=True)
+            sample_losses = model.loss.forward(output, y)
+            predictions = model.output_layer_activation.predictions(output)
+            comparisons = model.accuracy.compare(predictions, y)
+
+            model.backward(output, y)
+
+            connection.send((np.sum(sample_losses), len(sample_losses),
+                             np.sum(comparisons), comparisons.size))
+    except Exception:
+        connection.send(traceback.format_exc())
+    finally:
+        for memory in batch_memory.values():
+            memory.close()
+        parameters_memory.close()
+        gradients_memory.close()
+
+
+# Splits each batch across worker processes holding replicas of the model and all-reduces
+# their gradients through shared memory into the model's flat gradient array
+class Pool_DataParallel:
+    def __init__(self, model, workers):
+        # Statistics updated in the replicas would never reach the model
+        if any(hasattr(layer, 'running_mean') for layer in model.layers):
+            raise ValueError('Layers with running statistics cannot be trained with workers')
+
+        # Workers need flat parameters, the other finalize options are kept
+        if model.parameters is None:
+            model.finalize(flat_parameters=True, **getattr(model, 'finalize_options', {}))
+
+        self.model = model
+        self.workers = workers
+        flat = model.parameters
+        size = flat.weights.size
+
+        # Model parameters move to shared memory, the optimizer updates them there in place
+        self.parameters_memory = shared_memory.SharedMemory(create=True, size=flat.weights.nbytes)
+        flat.group('weights', np.ndarray(size, dtype=flat.weights.dtype,
+                                         buffer=self.parameters_memory.buf))
+
+        self.gradients_memory = shared_memory.SharedMemory(
+            create=True, size=workers * flat.dweights.nbytes)
+        self.gradients = np.ndarray((workers, size), dtype=flat.dweights.dtype,
+                                    buffer=self.gradients_memory.buf)
+
+        # Batches are copied once into shared memory, allocated on first use
+        self.batch_memory = {}
+
+        self.connections = []
+        self.processes = []
+        streams = model.random.spawn(workers)
+        for rank in range(workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=data_parallel_worker, daemon=True,
+                args=(model, rank, workers, worker_connection, self.parameters_memory.name,
+                      self.gradients_memory.name, streams[rank]))
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    # Copies an array into shared memory reused between batches, grown when too small
+    def share(self, key, array):
+        memory = self.batch_memory.get(key)
+        if memory is None or memory.size < array.nbytes:
+            if memory is not None:
+                memory.close()
+                memory.unlink()
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self.batch_memory[key] = memory
+
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+        shared[...] = array
+        return memory.name, array.shape, array.dtype.str
+
+    # Forward and backward pass of one batch, sets the model's gradients and accumulates loss and accuracy
+    def step(self, X, y):
+        if is_sparse(X):
+            raise ValueError('Data parallel training does not support sparse inputs')
+        X = np.asarray(X, dtype=self.model.dtype)
+        y = np.asarray(y)
+        message = (self.share('X', X), self.share('y', y), len(X))
+
+        for connection in self.connections:
+            connection.send(message)
+
+        samples = np.zeros(self.workers, dtype=self.model.dtype)
+        for rank, connection in enumerate(self.connections):
+            result = connection.recv()
+            if isinstance(result, str):
+                raise RuntimeError(f'Data parallel worker {rank} failed:\n{result}')
+
+            loss_sum, loss_count, accuracy_sum, accuracy_count = result
+            samples[rank] = loss_count
+            self.model.loss.accumulated_sum += loss_sum
+            self.model.loss.accumulated_count += loss_count
+            self.model.accuracy.accumulated_sum += accuracy_sum
+            self.model.accuracy.accumulated_count += accuracy_count
+
+        # All-reduce - gradients are averages over samples, so weight each worker by its share
+        np.dot(samples / len(X), self.gradients, out=self.model.parameters.dweights)
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join()
+
+        # Parameters are copied out of shared memory before it is released
+        flat = self.model.parameters
+        flat.group('weights', flat.weights.copy())
+
+        for memory in [self.parameters_memory, self.gradients_memory, *self.batch_memory.values()]:
+            memory.close()
+            memory.unlink()
+
+
+# Records wall time and bytes allocated per layer and phase, aggregated per epoch
+class Profiler:
+    def __init__(self, *, callback=None, track_memory=True):
+        # Called with each epoch's report when the epoch ends
+        self.callback = callback
+        # Allocations are traced with tracemalloc, which slows the measured code down
+        self.track_memory = track_memory
+        self.epochs = []
+        self.current = {}
+
+    # Calls function and adds its time and allocated bytes to the name/phase record
+    def measure(self, name, phase, function, *args):
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+
+        record = self.current.setdefault(name, {}).setdefault(
+            phase, {'calls': 0, 'time': 0.0, 'bytes': 0})
+        record['calls'] += 1
+        record['time'] += elapsed
+        if self.track_memory:
+            # Peak memory during the call above what was allocated before it
+            record['bytes'] += tracemalloc.get_traced_memory()[1] - memory_before
+
+        return result
+
+    # Closes the records of an epoch and passes them to the callback
+    def end_epoch(self, epoch):
+        report = {'epoch': epoch, 'layers': self.current}
+        self.epochs.append(report)
+        self.current = {}
+
+        if self.callback is not None:
+            self.callback(report)
+
+    # Per-epoch records - a list of {'epoch': n, 'layers': {name: {phase: {calls, time, bytes}}}}
+    def report(self):
+        return self.epochs
+
+    def stop(self):
+        if self.track_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+# Writes a model file from the header and blobs made by Model.file_contents
+def write_model_file(path, header_bytes, blobs):
+    data_start = len(Model.FILE_MAGIC) + 8 + len(header_bytes)
+    data_start += -data_start % Model.FILE_ALIGNMENT
+
+    with open(path, 'wb') as f:
+        f.write(Model.FILE_MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+
+        for blob_offset, array, *_ in blobs:
+            # Zero padding up to the aligned position of the blob
+            f.write(bytes(data_start + blob_offset - f.tell()))
+            array.tofile(f)
+
+
+# Writes checkpoints on a background thread, so training never waits for the disk
+class Checkpoint_Writer:
+    def __init__(self, path):
+        self.path = path
+        # Only the newest pending checkpoint is kept, older ones are dropped unwritten
+        self.pending = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            contents = self.pending.get()
+            if contents is None:
+                return
+            try:
+                # Written next to the target and renamed, a crash never leaves a partial file
+                temporary_path = f'{self.path}.tmp'
+                write_model_file(temporary_path, *contents)
+                os.replace(temporary_path, self.path)
+            except BaseException as exception:
+                self.error = exception
+
+    # Queues a snapshot from Model.file_contents(copy=True)
+    def write(self, contents):
+        while True:
+            try:
+                self.pending.put_nowait(contents)
+                return
+            except queue.Full:
+                try:
+                    self.pending.get_nowait()
+                except queue.Empty:
+                    pass
+
+    # Waits for the last checkpoint to be written
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
 class Model:
-    def __init__(self):
+    # Layer arrays written by save, optimizer state only when requested
+    PARAMETERS = ('weights', 'biases', 'master_weights', 'master_biases', 'running_mean', 'running_variance',
+                  'quantized_weights', 'weight_scales')
+    OPTIMIZER_STATE = ('weight_momentums', 'bias_momentums',
+                       'weight_cache', 'bias_cache')
+
+    # File header magic and alignment of array blobs, so they can be memory-mapped
+    FILE_MAGIC = b'NNFSMDL1'
+    FILE_ALIGNMENT = 64
+
+    # dtype is used for parameters, forward and backward, master_dtype (e.g. float64 with
+    # float32 dtype) keeps a higher precision copy of the parameters for optimizer updates.
+    # seed seeds the model's random generator, see new_generator
+    def __init__(self, *, dtype=np.float64, master_dtype=None, seed=None):
+        self.dtype = np.dtype(dtype)
+        self.master_dtype = None if master_dtype is None else np.dtype(master_dtype)
+
+        # Shuffling draws from this generator, dropout layers and data parallel workers from
+        # streams spawned from it. Layers take it as random to draw their initial weights from
+        # it, e.g. Layer_Dense(2, 64, random=model.random)
+        self.random = new_generator(seed)
+
         # Create a list of network objects
         self.layers = []
         # Softmax classifier's output object
         self.softmax_classifier_output = None
+        # Flat parameters, set by finalize
+        self.parameters = None
+        # Layers with fused Dense+activation pairs, set by finalize
+        self.compute_layers = None
+        # Profiler, set by profile
+        self.profiler = None
+        # Per-epoch summaries of the last train call, see plotting.py
+        self.history = {}
+        # Per-layer output buffers reused by predict
+        self.inference_buffers = {}
+        # Gradient sums and sample count of the current accumulation window
+        self.gradient_sums = []
+        self.row_samples = {}
+        self.accumulated_samples = 0
 
     # Add layers to the model
     def add(self, layer):
@@ -532,7 +1788,16 @@ class Model:
         self.optimizer = optimizer
         self.accuracy = accuracy
 
-    def finalize(self):
+    # With flat_parameters all parameters, gradients and optimizer state are stored in
+    # contiguous arrays and the optimizer updates the whole model in one call. With
+    # reuse_buffers layers and the loss compute into output and gradient arrays that are
+    # kept between batches instead of allocating new ones on every call.
+    # activation_checkpoints turns on recomputation - only the outputs of the given layer indices,
+    # or of every n-th layer for an integer n, are kept during training and the layers in between
+    # run forward again in backward
+    def finalize(self, *, flat_parameters=False, reuse_buffers=False, activation_checkpoints=None):
+        # Kept so the model can be finalized again with flat parameters, see Pool_DataParallel
+        self.finalize_options = {'reuse_buffers': reuse_buffers, 'activation_checkpoints': activation_checkpoints}
         self.input_layer = Layer_Input()
         layer_count = len(self.layers)
 
@@ -558,72 +1823,732 @@ class Model:
 
             if hasattr(self.layers[i], 'weights'):
                 self.trainable_layers.append(self.layers[i])
+                self.set_precision(self.layers[i])
 
             # Update loss object with trainable layers
             self.loss.remember_trainable_layers(self.trainable_layers)
 
+        # Inference buffers are allocated again on the first predict call
+        self.inference_buffers = {}
+
+        # Layers drawing random numbers get a stream of their own, kept when finalize runs again
+        for layer in self.layers:
+            if hasattr(layer, 'random') and layer.random is None:
+                layer.random = self.random.spawn(1)[0]
+
+        self.parameters = None
+        for layer in self.trainable_layers:
+            layer.dense_gradients = False
+        if flat_parameters and self.trainable_layers:
+            update_dtype = self.dtype if self.master_dtype is None else self.master_dtype
+            self.parameters = Parameters_Flat(self.trainable_layers, self.optimizer, update_dtype)
+
+        # Dense layers followed by ReLU or Sigmoid run as one fused object in forward, backward
+        # and infer, profiling and recomputation keep using the separate layers
+        self.compute_layers = []
+        fused_types = {Activation_ReLU: Layer_Dense_Activation_ReLU,
+                       Activation_Sigmoid: Layer_Dense_Activation_Sigmoid}
+        i = 0
+        while i < layer_count:
+            layer = self.layers[i]
+            fused_type = fused_types.get(type(self.layers[i+1])) if i < layer_count - 1 else None
+            if isinstance(layer, Layer_Dense) and fused_type is not None:
+                activation = self.layers[i+1]
+                layer = fused_type(layer, activation)
+                layer.prev = self.layers[i].prev
+                layer.next = activation.next
+                i += 1
+            self.compute_layers.append(layer)
+            i += 1
+
         # If output activation is Softmax and loss function is Categorical Cross-Entropy create an object of combined activation and loss function containing faster gradient calculation
         if isinstance(self.layers[-1], Activation_Softmax) and isinstance(self.loss, Loss_CategoricalCrossentropy):
             self.softmax_classifier_output = Activation_Softmax_Loss_CategoricalCrossentropy()
 
-    def train(self, X, y, *, epochs=1, print_every=1, validation_data=None):
-        self.accuracy.init(y)
-
+        # Segments of layers between kept outputs, as (start, end) index ranges
+        self.segments = None
+        if activation_checkpoints is not None:
+            if isinstance(activation_checkpoints, int):
+                activation_checkpoints = range(activation_checkpoints - 1, layer_count, activation_checkpoints)
+            ends = sorted({index + 1 for index in activation_checkpoints if 0 <= index < layer_count - 1})
+            self.segments = list(zip([0] + ends, ends + [layer_count]))
+            self.segment_random_states = [None] * len(self.segments)
+
+        for obj in [*self.layers, *self.compute_layers, self.loss, self.softmax_classifier_output]:
+            if obj is not None:
+                obj.reuse_buffers = reuse_buffers
+                if not reuse_buffers:
+                    obj.__dict__.pop('buffers', None)
+
+        # Buffers would keep the recomputed arrays alive, so only segment outputs can reuse them
+        if self.segments is not None:
+            for start, end in self.segments:
+                for layer in self.layers[start:end-1]:
+                    layer.reuse_buffers = False
+                    layer.__dict__.pop('buffers', None)
+
+    # With categorical cross-entropy, one-hot labels are turned into class indices up front,
+    # so loss, gradient and accuracy kernels index into outputs instead of using one-hot matrices.
+    # Soft targets, e.g. smoothed labels, are not one-hot and are kept as they are
+    def class_indices(self, y):
+        if isinstance(self.loss, Loss_CategoricalCrossentropy) and y is not None and np.ndim(y) == 2:
+            y = np.asarray(y)
+            if np.all((y == 0) | (y == 1)) and np.all(np.sum(y, axis=1) == 1):
+                return np.argmax(y, axis=1)
+        return y
+
+    # Casts layer parameters and optimizer state to the model's dtypes
+    def set_precision(self, layer):
+        if self.master_dtype is not None:
+            # Master copies restored by load are kept, otherwise made from the current parameters
+            if not hasattr(layer, 'master_weights'):
+                layer.master_weights = layer.weights
+                layer.master_biases = layer.biases
+            layer.master_weights = layer.master_weights.astype(self.master_dtype, copy=False)
+            layer.master_biases = layer.master_biases.astype(self.master_dtype, copy=False)
+            layer.weights = layer.master_weights.astype(self.dtype)
+            layer.biases = layer.master_biases.astype(self.dtype)
+        else:
+            layer.weights = layer.weights.astype(self.dtype, copy=False)
+            layer.biases = layer.biases.astype(self.dtype, copy=False)
+
+        # Running statistics of normalization layers are used with the parameters at inference
+        for name in ('running_mean', 'running_variance'):
+            if hasattr(layer, name):
+                setattr(layer, name, getattr(layer, name).astype(self.dtype, copy=False))
+
+        # Optimizer state follows the dtype of the parameters it updates
+        update_dtype = self.dtype if self.master_dtype is None else self.master_dtype
+        for name in self.OPTIMIZER_STATE:
+            if hasattr(layer, name):
+                setattr(layer, name, getattr(layer, name).astype(update_dtype, copy=False))
+
+    # With workers, every batch is split across that many processes holding model replicas
+    # Validation runs every validate_every epochs and after the last one. With patience, training
+    # stops once the monitored history metric has not improved by more than min_delta for that many
+    # checks. The best parameters can be restored at the end and written to checkpoint_path.
+    # With accumulation_steps, batch_size is a micro-batch and parameters are updated once
+    # per accumulation_steps micro-batches, as with a single batch that many times larger.
+    # callback is called with the model and the epoch after each epoch, returning True stops training
+    def train(self, X, y=None, *, epochs=1, batch_size=None, print_every=1, validation_data=None,
+              clip_norm=None, workers=None, validate_every=None, monitor='validation_loss',
+              patience=None, min_delta=0., restore_best=False, checkpoint_path=None,
+              accumulation_steps=1, callback=None):
+        # Arrays are wrapped in a data source, X can also be a Data object
+        train_data = X if isinstance(X, Data) else Data_Array(X, self.class_indices(y))
+        if validation_data is not None and not isinstance(validation_data, Data):
+            validation_data = Data_Array(validation_data[0], self.class_indices(validation_data[1]))
+
+        self.accuracy.init(train_data.init_y())
+
+        self.history = {'epoch': [], 'loss': [], 'data_loss': [], 'regularization_loss': [],
+                        'accuracy': [], 'learning_rate': []}
+        if validation_data is not None:
+            self.history.update(validation_epoch=[], validation_loss=[], validation_accuracy=[])
+
+        tracking = patience is not None or restore_best or checkpoint_path is not None
+        if tracking and monitor not in self.history:
+            raise ValueError(f'Cannot monitor {monitor}, it is not in the training history')
+
+        # Without a cadence, validation runs only after the last epoch unless it is monitored
+        validated_metric = monitor.startswith('validation')
+        if validate_every is None:
+            validate_every = 1 if tracking and validated_metric else epochs
+
+        # One-shot iterators are exhausted after a single pass
+        if getattr(train_data, 'one_shot', False) and epochs > 1:
+            raise ValueError('Training data from a one-shot iterator can be used for one epoch only, '
+                             'pass a callable returning a new iterator to Data_Iterator instead')
+        if getattr(validation_data, 'one_shot', False) and validate_every < epochs:
+            raise ValueError('Validation data from a one-shot iterator can be used once only, '
+                             'pass a callable returning a new iterator to Data_Iterator instead')
+
+        # Losses are minimized, other metrics maximized
+        sign = 1 if monitor.endswith('loss') else -1
+        best = best_epoch = best_contents = None
+        checks_without_improvement = 0
+
+        pool = Pool_DataParallel(self, workers) if workers else None
+        writer = Checkpoint_Writer(checkpoint_path) if checkpoint_path is not None else None
+        epochs_run = self.train_epochs(train_data, epochs, batch_size, print_every, clip_norm, pool,
+                                       accumulation_steps)
+        try:
+            for epoch in epochs_run:
+                validated = validation_data is not None and (not epoch % validate_every or epoch == epochs)
+                if validated:
+                    loss, accuracy = self.evaluate(validation_data, batch_size=batch_size)
+                    self.history['validation_epoch'].append(epoch)
+                    self.history['validation_loss'].append(float(loss))
+                    self.history['validation_accuracy'].append(float(accuracy))
+
+                if tracking and (validated or not validated_metric):
+                    value = sign * self.history[monitor][-1]
+                    if best is None or value < best - min_delta:
+                        best, best_epoch = value, epoch
+                        checks_without_improvement = 0
+
+                        # In-memory snapshot, the disk write happens on the writer's thread
+                        best_contents = self.file_contents(copy=True)
+                        if writer is not None:
+                            writer.write(best_contents)
+                    else:
+                        checks_without_improvement += 1
+                        if patience is not None and checks_without_improvement >= patience:
+                            print(f'Early stopping at epoch {epoch}, best {monitor}: {sign * best:.3f} at epoch {best_epoch}')
+                            break
+
+                if callback is not None and callback(self, epoch):
+                    break
+        finally:
+            epochs_run.close()
+            if pool is not None:
+                pool.close()
+            if writer is not None:
+                writer.close()
+
+        if restore_best and best_contents is not None:
+            self.restore(best_contents[1])
+
+    # Trains epoch by epoch, yielding the number of each finished epoch
+    def train_epochs(self, train_data, epochs, batch_size, print_every, clip_norm, pool,
+                     accumulation_steps=1):
         for epoch in range(1, epochs+1):
-            output = self.forward(X, training=True)
-
-            data_loss, regularization_loss = self.loss.calculate(
-                output, y, include_regularization=True)
-
+            # Reset accumulated values in loss and accuracy objects
+            self.loss.new_pass()
+            self.accuracy.new_pass()
+
+            for step, (batch_X, batch_y) in enumerate(train_data.batches(batch_size, shuffle=self.random), 1):
+                # One-hot labels from data sources are converted once per batch
+                batch_y = self.class_indices(batch_y)
+
+                if pool is not None:
+                    # Forward and backward passes run in the worker processes
+                    pool.step(batch_X, batch_y)
+                else:
+                    output = self.forward(batch_X, training=True)
+
+                    if self.profiler is None:
+                        self.loss.calculate(output, batch_y)
+                    else:
+                        self.profiler.measure('loss', 'calculate', self.loss.calculate, output, batch_y)
+
+                    predictions = self.output_layer_activation.predictions(output)
+                    self.accuracy.calculate(predictions, batch_y)
+
+                    # Backward pass
+                    self.backward(output, batch_y)
+
+                # Gradients are summed until the accumulation window is full
+                if accumulation_steps > 1:
+                    self.accumulate_gradients(len(batch_X))
+                    if step % accumulation_steps:
+                        continue
+                    self.apply_accumulated_gradients()
+
+                self.update_parameters(clip_norm)
+
+            # A shorter last window of the epoch is applied like a shorter last batch
+            if self.accumulated_samples:
+                self.apply_accumulated_gradients()
+                self.update_parameters(clip_norm)
+
+            # Epoch summary over all steps
+            data_loss, regularization_loss = self.loss.calculate_accumulated(
+                include_regularization=True)
             loss = data_loss + regularization_loss
+            accuracy = self.accuracy.calculate_accumulated()
 
-            predictions = self.output_layer_activation.predictions(output)
-            accuracy = self.accuracy.calculate(predictions, y)
-
-            # Backward pass
-            self.backward(output, y)
+            if self.profiler is not None:
+                self.profiler.end_epoch(epoch)
 
-            # Optimize (update parameters)
-            self.optimizer.pre_update_params()
-            for layer in self.trainable_layers:
-                self.optimizer.update_params(layer)
-            self.optimizer.post_update_params()
+            for name, value in (('epoch', epoch), ('loss', loss), ('data_loss', data_loss),
+                                ('regularization_loss', regularization_loss), ('accuracy', accuracy),
+                                ('learning_rate', self.optimizer.current_learning_rate)):
+                self.history[name].append(float(value))
 
             # Print a summary
             if not epoch % print_every:
                 print(f'Epoch: {epoch}, Acc: {accuracy:.3f}, Loss: {loss:.3f}, (Data_Loss: {data_loss:.3f}, Reg_Loss: {regularization_loss:.3f}), LR: {self.optimizer.current_learning_rate:.5f}')
 
-        # If there is the validation data
-        if validation_data is not None:
-            X_val, y_val = validation_data
+            yield epoch
+
+    # Evaluates the model on arrays or a Data object
+    def evaluate(self, X_val, y_val=None, *, batch_size=None):
+        validation_data = X_val if isinstance(X_val, Data) else Data_Array(X_val, self.class_indices(y_val))
 
-            output = self.forward(X_val, training=False)
+        self.loss.new_pass()
+        self.accuracy.new_pass()
 
-            loss = self.loss.calculate(output, y_val)
+        # Inference pass, layer states used by training are left untouched
+        for batch_X, batch_y in validation_data.batches(batch_size):
+            batch_y = self.class_indices(batch_y)
+            output = self.infer(batch_X)
+
+            self.loss.calculate(output, batch_y)
 
             predictions = self.output_layer_activation.predictions(output)
-            accuracy = self.accuracy.calculate(predictions, y_val)
+            self.accuracy.calculate(predictions, batch_y)
 
-            # Print a summary
-            print(f'| Validation | Acc: {accuracy:.3f}, Loss: {loss:.3f}')
+        loss = self.loss.calculate_accumulated()
+        accuracy = self.accuracy.calculate_accumulated()
+
+        # Print a summary
+        print(f'| Validation | Acc: {accuracy:.3f}, Loss: {loss:.3f}')
+
+        return loss, accuracy
+
+    # Turns per-layer instrumentation on or off, returns the profiler holding the records
+    def profile(self, enabled=True, *, callback=None, track_memory=True):
+        if self.profiler is not None:
+            self.profiler.stop()
+
+        self.profiler = Profiler(callback=callback, track_memory=track_memory) if enabled else None
+
+        # Names used in reports, the position keeps layers of the same type apart
+        self.layer_names = [f'{index}:{type(layer).__name__}'
+                            for index, layer in enumerate(self.layers)]
+        return self.profiler
+
+    # Global L2 norm of all parameter gradients
+    def gradient_norm(self):
+        if self.parameters is not None:
+            return np.sqrt(np.dot(self.parameters.dweights, self.parameters.dweights))
+
+        squared_sum = 0
+        for layer in self.trainable_layers:
+            squared_sum += np.sum(layer.dweights ** 2) + np.sum(layer.dbiases ** 2)
+        return np.sqrt(squared_sum)
+
+    # Scales gradients in place so their global norm is at most max_norm
+    def clip_gradients(self, max_norm):
+        norm = self.gradient_norm()
+        if norm <= max_norm:
+            return norm
+
+        scale = max_norm / (norm + 1e-7)
+        if self.parameters is not None:
+            self.parameters.dweights *= scale
+        else:
+            for layer in self.trainable_layers:
+                layer.dweights *= scale
+                layer.dbiases *= scale
+        return norm
+
+    # Clips gradients when clip_norm is given and runs an optimizer step
+    def update_parameters(self, clip_norm=None):
+        # Scale gradients down to a global norm of at most clip_norm
+        if clip_norm is not None:
+            self.clip_gradients(clip_norm)
+
+        # Optimize (update parameters)
+        self.optimize()
+
+    # Gradient arrays summed over the micro-batches of an accumulation window
+    def gradient_arrays(self):
+        if self.parameters is not None:
+            return [(self.parameters, 'dweights')]
+        return [(layer, name) for layer in self.trainable_layers for name in ('dweights', 'dbiases')]
+
+    # Adds the gradients of a micro-batch, weighted by its number of samples, to the window sums
+    def accumulate_gradients(self, samples):
+        first = self.accumulated_samples == 0
+        arrays = self.gradient_arrays()
+        del self.gradient_sums[len(arrays):]
+        self.gradient_sums += [None] * (len(arrays) - len(self.gradient_sums))
+        if first:
+            self.row_samples = {}
+
+        for index, (obj, name) in enumerate(arrays):
+            gradient = getattr(obj, name)
+            # Row-sparse weight gradients are added to the rows they cover
+            rows = getattr(obj, 'dweights_rows', None) if name == 'dweights' else None
+            shape = gradient.shape if rows is None else obj.weights.shape
+
+            total = self.gradient_sums[index]
+            if total is None or total.shape != shape or total.dtype != gradient.dtype:
+                total = self.gradient_sums[index] = np.zeros(shape, dtype=gradient.dtype)
+
+            # Gradients are overwritten by the next backward pass, so they are scaled in place
+            gradient *= samples
+            if rows is not None:
+                if first:
+                    total[...] = 0
+                total[rows] += gradient
+            elif first:
+                total[...] = gradient
+            else:
+                total += gradient
+
+        # Samples of the micro-batches using each weight row of layers with sparse inputs
+        for index, layer in enumerate(self.trainable_layers):
+            if not is_sparse(getattr(layer, 'inputs', None)):
+                continue
+            rows = layer.dweights_rows if self.parameters is None else layer.scattered_rows
+            if index not in self.row_samples:
+                self.row_samples[index] = np.zeros(layer.weights.shape[0], dtype=np.int64)
+            self.row_samples[index][rows] += samples
+
+        self.accumulated_samples += samples
+
+    # Replaces the gradients with the sample-weighted mean over the accumulation window
+    def apply_accumulated_gradients(self):
+        samples = self.accumulated_samples
+
+        for (obj, name), total in zip(self.gradient_arrays(), self.gradient_sums):
+            gradient = getattr(obj, name)
+            if gradient.shape == total.shape:
+                np.divide(total, samples, out=gradient)
+
+        for index, row_samples in self.row_samples.items():
+            layer = self.trainable_layers[index]
+            rows = np.flatnonzero(row_samples)
+
+            # Regularization is applied lazily, once per micro-batch using a row and weighted by
+            # its samples - the missing share is added, so it counts once as for a single batch
+            correction = np.zeros((len(rows), layer.weights.shape[1]), dtype=layer.dweights.dtype)
+            add_weight_regularization(layer, correction, layer.weights[rows])
+            correction *= (1 - row_samples[rows] / samples)[:, None]
+
+            if self.parameters is None:
+                # Row-sparse gradient of all rows used in the window
+                layer.dweights = self.gradient_sums[2 * index][rows] / samples + correction
+                layer.dweights_rows = rows
+            else:
+                layer.dweights[rows] += correction
+
+        self.accumulated_samples = 0
+
+    # Runs one optimizer step over all trainable layers, or over the flat parameters at once
+    def optimize(self):
+        layers = self.trainable_layers if self.parameters is None else [self.parameters]
+        update = self.optimizer.update_params if self.master_dtype is None else self.update_master_params
+
+        self.optimizer.pre_update_params()
+        if self.profiler is None:
+            for layer in layers:
+                update(layer)
+        else:
+            for layer in layers:
+                name = 'parameters' if layer is self.parameters else self.layer_names[self.layers.index(layer)]
+                self.profiler.measure(name, 'update', update, layer)
+        self.optimizer.post_update_params()
+
+    # Mixed precision update - the optimizer updates master parameters with upcast gradients,
+    # which are then copied into the lower precision parameters used by forward and backward
+    def update_master_params(self, layer):
+        weights, biases = layer.weights, layer.biases
+        dweights, dbiases = layer.dweights, layer.dbiases
+
+        layer.weights, layer.biases = layer.master_weights, layer.master_biases
+        layer.dweights = dweights.astype(self.master_dtype)
+        layer.dbiases = dbiases.astype(self.master_dtype)
+
+        self.optimizer.update_params(layer)
+
+        layer.weights, layer.biases = weights, biases
+        layer.dweights, layer.dbiases = dweights, dbiases
+        np.copyto(weights, layer.master_weights, casting='same_kind')
+        np.copyto(biases, layer.master_biases, casting='same_kind')
+
+    # Inference in batches - keeps no layer state, skips dropout and reuses output buffers
+    def predict(self, X, *, batch_size=None):
+        if batch_size is not None and batch_size <= 0:
+            raise ValueError(f'batch_size must be positive, got {batch_size}')
+
+        # Empty inputs still run through the layers, for the shape and dtype of the outputs
+        samples = X.shape[0]
+        if not samples:
+            return self.infer(X).copy()
+        if batch_size is None:
+            batch_size = samples
+
+        output = None
+
+        for start in range(0, samples, batch_size):
+            # After the first batch the last layer writes straight into the output array
+            out = None if output is None else output[start:start+batch_size]
+            batch_output = self.infer(X[start:start+batch_size], out)
+
+            if output is None:
+                output = np.empty((samples,) + batch_output.shape[1:], dtype=batch_output.dtype)
+                output[:len(batch_output)] = batch_output
+            elif batch_output is not out:
+                out[...] = batch_output
+
+        return output
+
+    # Inference pass over a single batch, intermediate results go to reused buffers - without out
+    # the returned array is one of these buffers and is overwritten by the next call. Nothing else
+    # is stored, so threads can run it at the same time when each passes its own buffers dict
+    def infer(self, batch_X, out=None, *, buffers=None):
+        if buffers is None:
+            buffers = self.inference_buffers
+
+        if is_sparse(batch_X):
+            batch_X = batch_X.astype(self.dtype, copy=False)
+        else:
+            batch_X = np.asarray(batch_X, dtype=self.dtype)
+        rows = batch_X.shape[0]
+        # Loaded models without a loss are not finalized and run their layers one by one
+        layers = self.layers if self.compute_layers is None else self.compute_layers
+        last_index = len(layers) - 1
+
+        batch_output = batch_X
+        for index, layer in enumerate(layers):
+            if index == last_index and out is not None:
+                layer_out = out
+            else:
+                buffer = buffers.get(index)
+                layer_out = buffer[:rows] if buffer is not None and len(buffer) >= rows else None
+
+            result = layer.infer(batch_output, layer_out)
+
+            # Keep newly allocated arrays as buffers, never the arrays passed in or views of them
+            # (e.g. reshaped by Layer_Flatten), which would be written into by the next call
+            if layer_out is None and (is_sparse(batch_output) or not np.shares_memory(result, batch_output)):
+                buffers[index] = result
+            batch_output = result
+
+        return batch_output
+
+    # Copy of the model for inference and export, with every batch normalization folded into the
+    # scale and shift of the dense or convolution layer before it, so it costs nothing to run
+    def folded(self):
+        model = copy.deepcopy(self)
+        model.profiler = None
+
+        layers = []
+        for layer in model.layers:
+            if isinstance(layer, Layer_BatchNorm) and layers and isinstance(layers[-1], (Layer_Dense, Layer_Conv2D)):
+                scale, shift = layer.scale_shift()
+                previous = layers[-1]
+                # Master copies are folded too, every array keeps its dtype
+                for prefix in ('', 'master_'):
+                    weights = getattr(previous, prefix + 'weights', None)
+                    if weights is not None:
+                        biases = getattr(previous, prefix + 'biases')
+                        setattr(previous, prefix + 'weights', (weights * scale).astype(weights.dtype, copy=False))
+                        setattr(previous, prefix + 'biases', (biases * scale + shift).astype(biases.dtype, copy=False))
+                continue
+            layers.append(layer)
+        model.layers = layers
+
+        if hasattr(model, 'loss'):
+            model.finalize()
+        else:
+            model.inference_buffers = {}
+        return model
+
+    # Folded copy of the model with every dense layer replaced by Layer_Dense_Int8, input ranges of
+    # the layers are calibrated on the samples of X_calibration
+    def quantized(self, X_calibration, *, batch_size=None):
+        model = self.folded()
+
+        input_ranges = [0.] * len(model.layers)
+        samples = X_calibration.shape[0]
+        if batch_size is None:
+            batch_size = samples
+        for start in range(0, samples, batch_size):
+            batch_output = X_calibration[start:start+batch_size]
+            batch_output = batch_output.astype(model.dtype, copy=False) if is_sparse(batch_output) else \
+                np.asarray(batch_output, dtype=model.dtype)
+            for index, layer in enumerate(model.layers):
+                if isinstance(layer, Layer_Dense):
+                    values = batch_output.data if is_sparse(batch_output) else batch_output
+                    if values.size:
+                        input_ranges[index] = max(input_ranges[index], float(np.max(np.abs(values))))
+                batch_output = layer.infer(batch_output)
+
+        model.layers = [Layer_Dense_Int8(layer, input_ranges[index]) if isinstance(layer, Layer_Dense) else layer
+                        for index, layer in enumerate(model.layers)]
+
+        if hasattr(model, 'loss'):
+            model.finalize()
+        else:
+            model.inference_buffers = {}
+        return model
+
+    # Bytes of the parameters and running statistics saved with the model
+    def parameter_bytes(self):
+        return sum(getattr(layer, name).nbytes for layer in self.layers
+                   for name in self.PARAMETERS if getattr(layer, name, None) is not None)
+
+    # Saves architecture, parameters and optionally optimizer state to a binary file
+    def save(self, path, *, include_optimizer=False):
+        write_model_file(path, *self.file_contents(include_optimizer))
+
+    # Header and aligned blobs of a model file, with copy=True the blobs are snapshots
+    # of the arrays that stay valid while training goes on
+    def file_contents(self, include_optimizer=False, *, copy=False):
+        array_names = self.PARAMETERS
+        if include_optimizer:
+            array_names += self.OPTIMIZER_STATE
+
+        header = {'dtype': self.dtype.str,
+                  'master_dtype': None if self.master_dtype is None else self.master_dtype.str,
+                  'layers': [], 'loss': None, 'optimizer': None, 'accuracy': None}
+        blobs = []
+        offset = 0
+
+        def describe(obj):
+            # Only plain scalar attributes are configuration, arrays and references are skipped
+            config = {}
+            for name, value in vars(obj).items():
+                if isinstance(value, np.generic):
+                    value = value.item()
+                if value is None or isinstance(value, (bool, int, float, str)):
+                    config[name] = value
+            return {'type': type(obj).__name__, 'config': config}
+
+        for layer in self.layers:
+            description = describe(layer)
+            description['arrays'] = {}
+
+            for name in array_names:
+                array = getattr(layer, name, None)
+                if array is None:
+                    continue
+                array = np.array(array, order='C') if copy else np.ascontiguousarray(array)
+
+                # Blobs are aligned so each one can be memory-mapped on its own
+                offset += -offset % self.FILE_ALIGNMENT
+                description['arrays'][name] = {
+                    'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset}
+                blobs.append((offset, array, layer, name))
+                offset += array.nbytes
+
+            header['layers'].append(description)
+
+        for name in ('loss', 'optimizer', 'accuracy'):
+            if hasattr(self, name):
+                header[name] = describe(getattr(self, name))
+
+        header['random'] = self.random_state()
+
+        return json.dumps(header).encode('utf-8'), blobs
+
+    # States of the model's generator and the layers' streams as JSON-serializable values,
+    # saved with the model so training resumes with the same random numbers
+    def random_state(self):
+        seed_sequence = self.random.bit_generator.seed_seq
+        return {'entropy': seed_sequence.entropy, 'spawned': seed_sequence.n_children_spawned,
+                'state': self.random.bit_generator.state,
+                'layers': [None if getattr(layer, 'random', None) is None else layer.random.bit_generator.state
+                           for layer in self.layers]}
+
+    def set_random_state(self, state):
+        # The spawn count is restored too, so streams spawned later are the same as well
+        seed_sequence = np.random.SeedSequence(state['entropy'], n_children_spawned=state['spawned'])
+        self.random = generator_from_state(state['state'], seed_sequence)
+        for layer, layer_state in zip(self.layers, state['layers']):
+            if layer_state is not None:
+                layer.random = generator_from_state(layer_state)
+
+    # Copies arrays of a file_contents snapshot back into the layers
+    def restore(self, blobs):
+        for _, array, layer, name in blobs:
+            np.copyto(getattr(layer, name), array)
+
+    # Loads a model saved with save - with mmap_mode='r' weights are read-only views of the file
+    # shared between processes, use 'c' or None to train the loaded model
+    @staticmethod
+    def load(path, *, mmap_mode='r'):
+        with open(path, 'rb') as f:
+            if f.read(len(Model.FILE_MAGIC)) != Model.FILE_MAGIC:
+                raise ValueError(f'{path} is not a saved model')
+            header_length = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_length).decode('utf-8'))
+
+        data_start = len(Model.FILE_MAGIC) + 8 + header_length
+        data_start += -data_start % Model.FILE_ALIGNMENT
+
+        def build(description):
+            cls = globals().get(description['type'])
+            if not isinstance(cls, type):
+                raise ValueError(f'Unknown object type {description["type"]}')
+
+            # Restore attributes without calling __init__, which would initialize new weights
+            obj = cls.__new__(cls)
+            obj.__dict__.update(description['config'])
+            return obj
+
+        model = Model(dtype=header['dtype'], master_dtype=header['master_dtype'])
+
+        for description in header['layers']:
+            layer = build(description)
+
+            for name, array in description['arrays'].items():
+                dtype = np.dtype(array['dtype'])
+                shape = tuple(array['shape'])
+                offset = data_start + array['offset']
+
+                if mmap_mode is None:
+                    count = int(np.prod(shape))
+                    value = np.fromfile(path, dtype=dtype, count=count,
+                                        offset=offset).reshape(shape)
+                else:
+                    value = np.memmap(path, dtype=dtype, mode=mmap_mode,
+                                      offset=offset, shape=shape)
+                setattr(layer, name, value)
+
+            model.add(layer)
+
+        # Files written before generator states were saved start new streams
+        if 'random' in header:
+            model.set_random_state(header['random'])
+
+        if header['loss'] is not None:
+            model.set(loss=build(header['loss']),
+                      optimizer=build(header['optimizer']),
+                      accuracy=build(header['accuracy']))
+            model.finalize()
+
+        return model
 
     def forward(self, X, training):
+        X = X.astype(self.dtype, copy=False) if is_sparse(X) else np.asarray(X, dtype=self.dtype)
+
         # Call forward method on the input layer this will set the output property that the first layer in "prev" object is expecting
         self.input_layer.forward(X, training)
 
-        for layer in self.layers:
+        # Instrumented loop in a separate method, so this one stays as it is
+        if self.profiler is not None:
+            return self.profiled_forward(training)
+
+        if self.segments is not None and training:
+            return self.segmented_forward()
+
+        for layer in self.compute_layers:
             layer.forward(layer.prev.output, training)
 
         return layer.output
 
+    def profiled_forward(self, training):
+        for name, layer in zip(self.layer_names, self.layers):
+            self.profiler.measure(name, 'forward', layer.forward, layer.prev.output, training)
+
+        return layer.output
+
     def backward(self, output, y):
+        # Targets are cast to the model's dtype, class indices are kept as they are
+        if y.ndim > 1 or y.dtype.kind == 'f':
+            y = np.asarray(y, dtype=self.dtype)
+
+        if self.profiler is not None:
+            self.profiled_backward(output, y)
+            return
+
+        if self.segments is not None and self.segment_random_states[0] is not None:
+            self.segmented_backward(output, y)
+            return
+
         if self.softmax_classifier_output is not None:
             # This will set dinputs property
             self.softmax_classifier_output.backward(output, y)
 
             self.layers[-1].dinputs = self.softmax_classifier_output.dinputs
 
-            for layer in reversed(self.layers[:-1]):
+            for layer in reversed(self.compute_layers[:-1]):
                 layer.backward(layer.next.dinputs)
 
             return
@@ -631,5 +2556,95 @@ class Model:
         # This will set dinputs property
         self.loss.backward(output, y)
 
-        for layer in reversed(self.layers):
+        for layer in reversed(self.compute_layers):
             layer.backward(layer.next.dinputs)
+
+    # Training forward pass that keeps only the outputs at the ends of segments
+    def segmented_forward(self):
+        for index, (start, end) in enumerate(self.segments):
+            # States the segment's streams start with, so dropout masks come out the same when recomputed
+            self.segment_random_states[index] = [
+                (layer, layer.random.bit_generator.state) for layer in self.layers[start:end]
+                if getattr(layer, 'random', None) is not None]
+
+            for layer in self.layers[start:end]:
+                layer.forward(layer.prev.output, True)
+
+            # The last segment is used by backward right away
+            if index < len(self.segments) - 1:
+                self.release_segment(index)
+
+        return layer.output
+
+    # Runs the layers of a segment forward again from the output kept before it
+    def recompute_segment(self, index):
+        start, end = self.segments[index]
+
+        # Streams are only used by their layers, drawing the same numbers again leaves them where
+        # the first forward pass did
+        for layer, random_state in self.segment_random_states[index]:
+            layer.random.bit_generator.state = random_state
+
+        # Running statistics were updated by the first forward pass already
+        statistics = [(layer, layer.running_mean.copy(), layer.running_variance.copy())
+                      for layer in self.layers[start:end] if hasattr(layer, 'running_mean')]
+
+        for layer in self.layers[start:end]:
+            layer.forward(layer.prev.output, True)
+
+        for layer, running_mean, running_variance in statistics:
+            layer.running_mean[...] = running_mean
+            layer.running_variance[...] = running_variance
+
+    # Drops per-batch arrays of the layers in a segment, except the output of its last layer
+    def release_segment(self, index):
+        start, end = self.segments[index]
+        for layer in self.layers[start:end]:
+            # The first layer's inputs are the kept output of the segment before
+            names = ('binary_mask', 'columns', 'normalized', 'inverse_std', 'dinputs')
+            if layer is not self.layers[start]:
+                names += ('inputs',)
+            for name in names:
+                if getattr(layer, name, None) is not None:
+                    setattr(layer, name, None)
+            if layer is not self.layers[end-1]:
+                layer.output = None
+
+    # Backward pass segment by segment, each one recomputed right before its gradients are needed
+    def segmented_backward(self, output, y):
+        layers = self.layers
+        if self.softmax_classifier_output is not None:
+            self.softmax_classifier_output.backward(output, y)
+            self.layers[-1].dinputs = self.softmax_classifier_output.dinputs
+            layers = self.layers[:-1]
+        else:
+            self.loss.backward(output, y)
+
+        last = len(self.segments) - 1
+        for index in reversed(range(len(self.segments))):
+            start, end = self.segments[index]
+            if index < last:
+                self.recompute_segment(index)
+
+            for layer in reversed(layers[start:end]):
+                layer.backward(layer.next.dinputs)
+
+            # Gradients of the segment after this one have been passed on
+            if index < last:
+                self.release_segment(index + 1)
+        self.release_segment(0)
+
+        self.segment_random_states = [None] * len(self.segments)
+
+    def profiled_backward(self, output, y):
+        layers = self.layers
+        if self.softmax_classifier_output is not None:
+            self.profiler.measure('loss', 'backward', self.softmax_classifier_output.backward, output, y)
+            self.layers[-1].dinputs = self.softmax_classifier_output.dinputs
+            layers = self.layers[:-1]
+        else:
+            self.profiler.measure('loss', 'backward', self.loss.backward, output, y)
+
+        for index in reversed(range(len(layers))):
+            layer = layers[index]
+            self.profiler.measure(self.layer_names[index], 'backward', layer.backward, layer.next.dinputs)
@@ -0,0 +1,34 @@
+# Plots of training curves. matplotlib is imported only when a plot is made,
+# so importing network (or this module) never loads it.
+
+
+# Plots metrics recorded in Model.history against the epoch, one subplot per metric
+def plot_history(history, metrics=('loss', 'accuracy'), *, path=None, show=None):
+    import matplotlib.pyplot as plt
+
+    figure, axes = plt.subplots(len(metrics), 1, sharex=True, squeeze=False,
+                                figsize=(8, 3 * len(metrics)))
+
+    for axis, metric in zip(axes[:, 0], metrics):
+        axis.plot(history['epoch'], history[metric], label=metric)
+
+        # Validation values are plotted at the epochs they were measured
+        validation = history.get('validation_' + metric)
+        if validation:
+            epochs = history.get('validation_epoch', history['epoch'][-len(validation):])
+            axis.plot(epochs, validation, 'o-', label='validation_' + metric)
+
+        axis.set_ylabel(metric)
+        axis.legend()
+
+    axes[-1, 0].set_xlabel('epoch')
+    figure.tight_layout()
+
+    if path is not None:
+        figure.savefig(path)
+
+    # Show only when not saving, unless asked explicitly
+    if show or (show is None and path is None):
+        plt.show()
+
+    return figure
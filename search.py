@@ -0,0 +1,207 @@
+# Hyperparameter search - grid, random and successive halving - over models built from configs.
+# Trials train in parallel worker processes, which read the training and validation arrays
+# from shared memory instead of getting a pickled copy each.
+import itertools
+import multiprocessing
+import os
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# Every combination of the values in space, a dict of name: list of values
+def grid_configs(space):
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+# count configs sampled from space - lists are choices, callables are called with a numpy
+# Generator and any other value is used as it is
+def random_configs(space, count, seed=0):
+    rng = np.random.default_rng(seed)
+
+    def sample(value):
+        if callable(value):
+            return value(rng)
+        if isinstance(value, list):
+            return value[rng.integers(len(value))]
+        return value
+
+    return [{name: sample(value) for name, value in space.items()} for _ in range(count)]
+
+
+# Sampler for random_configs, uniform in log space - for learning rates, decays and regularizers
+def log_uniform(low, high):
+    return lambda rng: float(np.exp(rng.uniform(np.log(low), np.log(high))))
+
+
+# Shared arrays attached in a worker process, by shared memory name
+worker_arrays = {}
+
+
+def attach_array(name, shape, dtype):
+    if name not in worker_arrays:
+        memory = shared_memory.SharedMemory(name=name)
+        worker_arrays[name] = (memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf))
+    return worker_arrays[name][1]
+
+
+def search_worker_init():
+    # Training output of the trials is dropped
+    sys.stdout = open(os.devnull, 'w')
+
+
+# Trains one trial in a worker process. Validation runs after every epoch and its best value so
+# far is written to the trial's row of curves. With median stopping the trial ends once that is
+# worse than the median of the other trials at the same epoch
+def run_trial(task):
+    (build, config, trial, seed, model, start_epoch, epochs, batch_size, monitor,
+     data_specs, curves_spec, median_stopping, min_epochs) = task
+
+    X, y, X_val, y_val = (None if spec is None else attach_array(*spec) for spec in data_specs)
+    curves = attach_array(*curves_spec)
+    sign = 1 if monitor.endswith('loss') else -1
+
+    if model is None:
+        # Models built without a seed of their own are seeded from the global random state
+        np.random.seed(seed)
+        model = build(config)
+
+    stopped = False
+
+    def callback(model, epoch):
+        nonlocal stopped
+        total_epoch = start_epoch + epoch
+        value = sign * model.history[monitor][-1]
+        previous = curves[trial, total_epoch - 2] if total_epoch > 1 else np.inf
+        curves[trial, total_epoch - 1] = min(value, previous)
+
+        if not median_stopping or total_epoch < min_epochs:
+            return False
+
+        others = np.delete(curves[:, total_epoch - 1], trial)
+        others = others[~np.isnan(others)]
+        stopped = len(others) >= 2 and curves[trial, total_epoch - 1] > np.median(others)
+        return stopped
+
+    model.train(X, y, epochs=epochs, batch_size=batch_size, print_every=epochs + 1,
+                validation_data=(X_val, y_val), validate_every=1, callback=callback)
+
+    return trial, model, model.history, stopped
+
+
+# Runs trials of models built by build(config) - a function that returns a finalized Model and can
+# be pickled, so defined at module level. Results are ranked by the monitored validation metric
+class Search:
+    def __init__(self, build, X, y, validation_data, *, workers=None, batch_size=None,
+                 monitor='validation_loss', seed=0):
+        if not monitor.startswith('validation'):
+            raise ValueError(f'Trials are compared on validation metrics, not {monitor}')
+
+        self.build = build
+        self.batch_size = batch_size
+        self.monitor = monitor
+        self.seed = seed
+
+        # Read-only data is copied once into shared memory, workers attach to it by name
+        self.memories = []
+        self.data_specs = [self.share(array) for array in (X, y, *validation_data)]
+
+        self.pool = multiprocessing.Pool(workers, initializer=search_worker_init)
+
+    # Copies an array into a new shared memory block, returns what workers need to attach to it
+    def share(self, array):
+        array = np.ascontiguousarray(array)
+        memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.memories.append(memory)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+        return memory.name, array.shape, array.dtype.str
+
+    def unshare(self, spec):
+        for memory in self.memories:
+            if memory.name == spec[0]:
+                self.memories.remove(memory)
+                memory.close()
+                memory.unlink()
+                return
+
+    # Trains each config for up to epochs, with median stopping of clearly losing trials from
+    # min_epochs on. Results come best first, see run_trials
+    def run(self, configs, epochs, *, median_stopping=True, min_epochs=2):
+        trials = [self.new_trial(trial, config) for trial, config in enumerate(configs)]
+        curves_spec = self.share(np.full((len(configs), epochs), np.nan))
+        self.run_trials(trials, epochs, curves_spec, median_stopping, min_epochs)
+        self.unshare(curves_spec)
+        return self.results(trials)
+
+    def grid(self, space, epochs, **options):
+        return self.run(grid_configs(space), epochs, **options)
+
+    def random(self, space, count, epochs, **options):
+        return self.run(random_configs(space, count, self.seed), epochs, **options)
+
+    # Successive halving - all configs train for min_epochs, then the best 1/eta of them continue
+    # to eta times more epochs, and so on until max_epochs or a single trial is left
+    def successive_halving(self, configs, *, min_epochs=1, max_epochs=27, eta=3):
+        trials = [self.new_trial(trial, config) for trial, config in enumerate(configs)]
+        curves_spec = self.share(np.full((len(configs), max_epochs), np.nan))
+
+        survivors = trials
+        budget = min_epochs
+        while True:
+            self.run_trials(survivors, budget, curves_spec, median_stopping=False, min_epochs=budget)
+
+            if budget >= max_epochs or len(survivors) <= 1:
+                break
+            survivors = self.results(survivors)[:max(1, len(survivors) // eta)]
+            budget = min(budget * eta, max_epochs)
+
+        self.unshare(curves_spec)
+        return self.results(trials)
+
+    def new_trial(self, trial, config):
+        return {'trial': trial, 'config': config, 'epochs': 0, 'score': None,
+                'stopped': False, 'history': {}, 'model': None}
+
+    # Trains trials in the pool until each has run total_epochs, continuing their models
+    def run_trials(self, trials, total_epochs, curves_spec, median_stopping, min_epochs):
+        tasks = [(self.build, trial['config'], trial['trial'], self.seed + trial['trial'],
+                  trial['model'], trial['epochs'], total_epochs - trial['epochs'], self.batch_size,
+                  self.monitor, self.data_specs, curves_spec, median_stopping, min_epochs)
+                 for trial in trials if total_epochs > trial['epochs'] and not trial['stopped']]
+        by_number = {trial['trial']: trial for trial in trials}
+        sign = 1 if self.monitor.endswith('loss') else -1
+
+        for number, model, history, stopped in self.pool.imap_unordered(run_trial, tasks):
+            trial = by_number[number]
+            trial['model'] = model
+            trial['stopped'] = stopped
+
+            # Epoch numbers of a continued trial count on from its earlier runs
+            for name, values in history.items():
+                if name in ('epoch', 'validation_epoch'):
+                    values = [trial['epochs'] + epoch for epoch in values]
+                trial['history'].setdefault(name, []).extend(values)
+            trial['epochs'] = int(trial['history']['epoch'][-1])
+            trial['score'] = sign * min(sign * value for value in trial['history'][self.monitor])
+
+    # Trials best first - {trial, config, epochs, score, stopped, history, model}, score being
+    # the best value of the monitored metric
+    def results(self, trials):
+        sign = 1 if self.monitor.endswith('loss') else -1
+        return sorted(trials, key=lambda trial: sign * trial['score'])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+        self.memories = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
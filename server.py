@@ -0,0 +1,167 @@
+# Batched inference for many small concurrent requests. Requests arriving within a latency
+# budget are stacked into one batch and run on a thread pool, so the matrix products work
+# on full batches instead of a few rows each.
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+
+# Re-entrant inference over a finalized model - parameters are only read and every thread
+# gets its own intermediate buffers, so any number of threads can predict at once
+class Inference_Engine:
+    def __init__(self, model):
+        self.model = model
+        self.local = threading.local()
+
+    # Model outputs for X as a new array
+    def predict(self, X):
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            buffers = self.local.buffers = {}
+
+        return self.model.infer(X, buffers=buffers).copy()
+
+    # Class predictions or values from model outputs
+    def predictions(self, outputs):
+        return self.model.output_layer_activation.predictions(outputs)
+
+
+# Collects concurrent requests into batches of up to max_batch_size rows, waiting at most
+# max_latency seconds after the first request of a batch, and runs the batches on threads.
+# Requests are never split, one larger than max_batch_size runs as a batch of its own
+class Inference_Server:
+    def __init__(self, model, *, max_batch_size=256, max_latency=0.005, threads=2, callback=None):
+        self.engine = model if isinstance(model, Inference_Engine) else Inference_Engine(model)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        # Called with the record of each finished batch
+        self.callback = callback
+
+        self.records = []
+        self.records_lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        # A batch is formed only when a thread is free to run it, requests arriving while all
+        # threads are busy wait in the queue and go into the next batch together
+        self.free_threads = threading.Semaphore(threads)
+        self.batcher = threading.Thread(target=self.collect_batches, daemon=True)
+        self.batcher.start()
+
+    # Queues the rows of X, the future resolves to their model outputs
+    def submit(self, X):
+        future = Future()
+        self.requests.put((np.asarray(X), future, time.perf_counter()))
+        return future
+
+    # Blocking version of submit
+    def predict(self, X):
+        return self.submit(X).result()
+
+    def collect_batches(self):
+        stopping = False
+        # A request that did not fit into the last batch starts the next one
+        held = None
+
+        while True:
+            self.free_threads.acquire()
+            if held is not None:
+                request, held = held, None
+            elif stopping:
+                break
+            else:
+                request = self.requests.get()
+                if request is None:
+                    break
+            batch = [request]
+            rows = len(request[0])
+
+            # More requests join the batch until it is full or the first one has waited long enough,
+            # requests already queued join it even after that
+            deadline = request[2] + self.max_latency
+            while rows < self.max_batch_size and not stopping:
+                timeout = deadline - time.perf_counter()
+                try:
+                    if timeout > 0:
+                        request = self.requests.get(timeout=timeout)
+                    else:
+                        request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                if rows + len(request[0]) > self.max_batch_size:
+                    held = request
+                    break
+                batch.append(request)
+                rows += len(request[0])
+
+            self.executor.submit(self.run_batch, batch)
+
+    def run_batch(self, batch):
+        start = time.perf_counter()
+        try:
+            X = batch[0][0] if len(batch) == 1 else np.concatenate([request[0] for request in batch])
+            output = self.engine.predict(X)
+        except BaseException as exception:
+            for _, future, _ in batch:
+                future.set_exception(exception)
+            return
+        finally:
+            self.free_threads.release()
+        end = time.perf_counter()
+
+        # Each request gets a view of its rows of the batch output
+        offset = 0
+        for inputs, future, _ in batch:
+            future.set_result(output[offset:offset+len(inputs)])
+            offset += len(inputs)
+
+        record = {'requests': len(batch), 'rows': offset, 'wait': start - batch[0][2],
+                  'compute': end - start, 'latency': end - batch[0][2],
+                  'submitted': batch[0][2], 'finished': end}
+        with self.records_lock:
+            self.records.append(record)
+
+        if self.callback is not None:
+            self.callback(record)
+
+    # Summary of the batches run so far - batch sizes, latencies of the oldest request in
+    # each batch (queue wait plus compute) in seconds, and rows per second while serving
+    def stats(self):
+        with self.records_lock:
+            records = list(self.records)
+
+        if not records:
+            return {'batches': 0, 'requests': 0, 'rows': 0}
+
+        rows = sum(record['rows'] for record in records)
+        latencies = np.array([record['latency'] for record in records])
+        elapsed = max(record['finished'] for record in records) - \
+            min(record['submitted'] for record in records)
+
+        return {'batches': len(records),
+                'requests': sum(record['requests'] for record in records),
+                'rows': rows,
+                'mean_batch_rows': rows / len(records),
+                'mean_wait': float(np.mean([record['wait'] for record in records])),
+                'mean_compute': float(np.mean([record['compute'] for record in records])),
+                'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p95': float(np.percentile(latencies, 95)),
+                'latency_max': float(latencies.max()),
+                'throughput': rows / elapsed if elapsed > 0 else 0.}
+
+    # Finishes queued requests and stops the threads
+    def close(self):
+        self.requests.put(None)
+        self.batcher.join()
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()